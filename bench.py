@@ -0,0 +1,199 @@
+import argparse
+import contextlib
+import http.server
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+
+latin = ['ka', 'ro', 'mi', 'te', 'lo', 'sa', 'nu', 'vi', 'de', 'pa']
+cyrillic = ['ма', 'ко', 'ре', 'ни', 'ло', 'ту', 'ва', 'ды', 'же', 'пе', 'ст', 'гу']
+
+
+# Синтетический сайт: словарь из латинских и русских слов, частоты слов по
+# закону Ципфа (s = zipf), на каждой странице links ссылок, цели ссылок тоже
+# распределены по Ципфу, так что у графа есть популярные страницы.
+# Возвращает словарь путь -> содержимое страницы и словарь
+def makecorpus(pages=1000, vocabulary=5000, words=300, links=10, zipf=1.1, cyrillicshare=0.5, seed=0):
+    rnd = random.Random(seed)
+    vocab = []
+    seen = set()
+    while len(vocab) < vocabulary:
+        syllables = cyrillic if rnd.random() < cyrillicshare else latin
+        word = ''.join(rnd.choice(syllables) for _ in range(rnd.randint(2, 4)))
+        if word not in seen:
+            seen.add(word)
+            vocab.append(word)
+
+    wordweights = [1.0 / (rank ** zipf) for rank in range(1, vocabulary + 1)]
+    pageweights = [1.0 / (rank ** zipf) for rank in range(1, pages + 1)]
+    corpus = {}
+    for i in range(pages):
+        text = ' '.join(rnd.choices(vocab, wordweights, k=words))
+        anchors = ''.join(
+            f'<a href="/p{target}">{" ".join(rnd.choices(vocab, wordweights, k=2))}</a>\n'
+            for target in rnd.choices(range(pages), pageweights, k=links)
+        )
+        corpus[f'/p{i}'] = (
+            f'<html><head><meta charset="utf-8"><title>p{i}</title></head>'
+            f'<body><p>{text}</p>\n{anchors}</body></html>'
+        ).encode('utf-8')
+    return corpus, vocab, wordweights
+
+
+# Локальный HTTP-сервер, раздающий корпус. Возвращает (сервер, базовый URL)
+def servecorpus(corpus):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = corpus.get(self.path)
+            if body is None:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+# Пиковый размер резидентной памяти процесса в мегабайтах
+def peakrss():
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return usage / (1024.0 * 1024.0) if sys.platform == 'darwin' else usage / 1024.0
+
+
+# Итог этапа: число операций, время, пропускная способность, перцентили
+# задержек (если замерялась каждая операция) и пиковая память на конец этапа
+def summary(count, elapsed, latencies=None):
+    result = {
+        'count': count,
+        'seconds': round(elapsed, 6),
+        'throughput': round(count / elapsed, 3) if elapsed > 0 else None,
+        'peak_rss_mb': round(peakrss(), 3)
+    }
+    if latencies:
+        ms = 1000.0 * np.array(latencies)
+        result['latency_ms'] = dict([(name, round(float(np.percentile(ms, q)), 3))
+                                     for (name, q) in [('p50', 50), ('p95', 95), ('p99', 99)]])
+        result['latency_ms']['mean'] = round(float(ms.mean()), 3)
+    return result
+
+
+# Полный прогон: обход сайта, PageRank, запросы и обучение нейросети.
+# Базы создаются в каталоге workdir; searchengine импортируется после перехода
+# в него, чтобы его nn.db тоже оказалась там
+def run(args):
+    os.chdir(args.workdir)
+    import nn
+    import searchengine
+    from instrument import metrics
+    if args.metrics:
+        metrics.enable()
+
+    corpus, vocab, wordweights = makecorpus(args.pages, args.vocabulary, args.words, args.links,
+                                            args.zipf, args.cyrillic, args.seed)
+    server, base = servecorpus(corpus)
+    report = {'config': vars(args), 'stages': {}}
+    stages = report['stages']
+    devnull = open(os.devnull, 'w')
+    try:
+        dbname = os.path.join(args.workdir, 'bench.db')
+        if os.path.exists(dbname):
+            os.remove(dbname)
+        crawler = searchengine.Crawler(dbname, bulk=args.bulk)
+        crawler.createindextables()
+
+        # Без --depth обходятся все страницы корпуса за один уровень
+        seeds = [base + '/p0'] if args.depth > 1 else [base + path for path in corpus]
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(devnull):
+            if args.workers > 0:
+                crawler.crawlconcurrent(seeds, args.depth, workers=args.workers)
+            else:
+                crawler.crawl(seeds, args.depth)
+        indexed = crawler.con.execute("SELECT count(*) FROM wordlocation").fetchone()[0]
+        stages['crawl'] = summary(crawler.indexstats['pages'], time.perf_counter() - start)
+        stages['crawl']['words'] = indexed
+
+        start = time.perf_counter()
+        crawler.buildpostings()
+        stages['buildpostings'] = summary(1, time.perf_counter() - start)
+
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(devnull):
+            crawler.calculatepagerank()
+        stages['pagerank'] = summary(1, time.perf_counter() - start)
+
+        # Запросы из 1-3 слов с теми же частотами, что и в корпусе
+        rnd = random.Random(args.seed + 1)
+        queries = [' '.join(rnd.choices(vocab, wordweights, k=rnd.randint(1, 3))) for _ in range(args.queries)]
+        searcher = searchengine.Searcher(dbname)
+        results = []
+        latencies = []
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(devnull):
+            for q in queries:
+                t = time.perf_counter()
+                results.append(searcher.query(q))
+                latencies.append(time.perf_counter() - t)
+        stages['query'] = summary(len(queries), time.perf_counter() - start, latencies)
+
+        net = nn.searchnet(os.path.join(args.workdir, 'benchnn.db'))
+        trained = [(wordids, urlids) for (wordids, urlids) in results if wordids and urlids]
+        latencies = []
+        start = time.perf_counter()
+        for i in range(args.train):
+            (wordids, urlids) = trained[i % len(trained)] if trained else ([], [])
+            if not urlids:
+                break
+            t = time.perf_counter()
+            net.trainQuery(wordids, urlids, rnd.choice(urlids))
+            latencies.append(time.perf_counter() - t)
+        stages['trainQuery'] = summary(len(latencies), time.perf_counter() - start, latencies)
+    finally:
+        server.shutdown()
+        devnull.close()
+
+    report['peak_rss_mb'] = round(peakrss(), 3)
+    if args.metrics:
+        report['metrics'] = metrics.snapshot()
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Замер скорости поисковика на синтетическом сайте')
+    parser.add_argument('--pages', type=int, default=1000)
+    parser.add_argument('--vocabulary', type=int, default=5000)
+    parser.add_argument('--words', type=int, default=300, help='слов на странице')
+    parser.add_argument('--links', type=int, default=10, help='ссылок на странице')
+    parser.add_argument('--zipf', type=float, default=1.1, help='показатель закона Ципфа')
+    parser.add_argument('--cyrillic', type=float, default=0.5, help='доля русских слов в словаре')
+    parser.add_argument('--depth', type=int, default=1, help='глубина обхода от /p0 (1 - все страницы сразу)')
+    parser.add_argument('--workers', type=int, default=0, help='потоков загрузки (0 - crawl)')
+    parser.add_argument('--bulk', action='store_true', help='пакетная запись индекса')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--train', type=int, default=100, help='вызовов trainQuery')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--metrics', action='store_true', help='добавить в отчёт замеры этапов и SQL')
+    parser.add_argument('--workdir', default=None, help='каталог для баз (по умолчанию временный)')
+    parser.add_argument('--output', default=None, help='файл для JSON-отчёта')
+    args = parser.parse_args()
+    args.workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix='searchbench'))
+
+    report = json.dumps(run(args), ensure_ascii=False)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(report + '\n')
+    print(report)
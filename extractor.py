@@ -0,0 +1,146 @@
+from html.parser import HTMLParser
+import codecs
+import re
+
+splitter = re.compile(r'\W+')
+wordtail = re.compile(r'\w*$')
+tagpattern = re.compile(r'<[^>]*>?')
+hrefpattern = re.compile(r'''<a\s[^>]*href\s*=\s*["']?([^"'\s>]+)''', re.I)
+charsetpattern = re.compile(rb'''<meta[^>]+charset\s*=\s*["']?([\w-]+)''', re.I)
+
+# Содержимое этих тегов не является текстом страницы
+skiptags = set(['script', 'style', 'noscript', 'template'])
+
+
+# Перевод загруженных байтов в текст: кодировка из <meta charset>, иначе
+# UTF-8, а для старых русскоязычных сайтов - windows-1251. У обрезанной
+# страницы (truncated=True) граница могла прийтись на середину символа:
+# неполный символ в конце отбрасывается, а не считается ошибкой кодировки
+def decode(content, truncated=False):
+    if isinstance(content, str):
+        return content
+    match = charsetpattern.search(content[:4096])
+    if match is not None:
+        try:
+            decoder = codecs.getincrementaldecoder(match.group(1).decode('ascii'))(errors='replace')
+            return decoder.decode(content, final=not truncated)
+        except LookupError:
+            pass
+    try:
+        return codecs.getincrementaldecoder('utf-8')().decode(content, final=not truncated)
+    except UnicodeDecodeError:
+        return content.decode('cp1251', errors='replace')
+
+
+# Событийный разбор HTML за один проход. Накапливает события
+# ('word', слово, позиция) и ('link', href, текст ссылки), которые забирает
+# extract после каждой порции входных данных. Текст копится до ближайшего
+# тега, чтобы граница порции не разрезала слово
+class PageParser(HTMLParser):
+    def __init__(self, maxwords, maxpending=65536):
+        super().__init__(convert_charrefs=True)
+        self.maxwords = maxwords
+        self.maxpending = maxpending
+        self.position = 0
+        self.skipdepth = 0
+        self.anchor = None
+        self.pending = []
+        self.pendingsize = 0
+        self.events = []
+
+    def handle_starttag(self, tag, attrs):
+        self.flushtext()
+        if tag in skiptags:
+            self.skipdepth += 1
+        elif tag == 'a':
+            self.closeanchor()
+            href = dict(attrs).get('href')
+            self.anchor = (href, []) if href is not None else None
+
+    def handle_endtag(self, tag):
+        self.flushtext()
+        if tag in skiptags:
+            self.skipdepth = max(self.skipdepth - 1, 0)
+        elif tag == 'a':
+            self.closeanchor()
+
+    def handle_startendtag(self, tag, attrs):
+        self.flushtext()
+
+    def handle_data(self, data):
+        if self.skipdepth:
+            return
+        self.pending.append(data)
+        self.pendingsize += len(data)
+        if self.pendingsize > self.maxpending:
+            # Длинный текст без тегов: разбираем всё, кроме недописанного слова
+            text = ''.join(self.pending)
+            tail = wordtail.search(text)
+            self.pending = [tail.group()]
+            self.pendingsize = len(tail.group())
+            self.addtext(text[:tail.start()])
+
+    def flushtext(self):
+        if self.pending:
+            text = ''.join(self.pending)
+            self.pending = []
+            self.pendingsize = 0
+            self.addtext(text)
+
+    def addtext(self, data):
+        for word in splitter.split(data):
+            if word == '':
+                continue
+            word = word.lower()
+            if self.anchor is not None:
+                self.anchor[1].append(word)
+            if self.position < self.maxwords:
+                self.events.append(('word', word, self.position))
+            self.position += 1
+
+    def closeanchor(self):
+        if self.anchor is not None:
+            (href, words) = self.anchor
+            self.events.append(('link', href, ' '.join(words)))
+            self.anchor = None
+
+    def close(self):
+        super().close()
+        self.flushtext()
+        self.closeanchor()
+
+    def drain(self):
+        events = self.events
+        self.events = []
+        return events
+
+
+# Генератор событий страницы: слова текста с их позициями (в том же
+# порядке нумерации, что separatewords) и ссылки с текстом. Страница
+# обрабатывается порциями по chunksize символов, в память попадают не более
+# maxbytes символов и maxwords слов. Если разбор разметки ломается, остаток
+# страницы обрабатывается грубо: теги вырезаются регулярным выражением
+def extract(content, maxwords=100000, maxbytes=4 * 1024 * 1024, chunksize=65536):
+    html = decode(content[:maxbytes], len(content) > maxbytes)
+    parser = PageParser(maxwords)
+    offset = 0
+    saved = (0, [])
+    try:
+        while offset < len(html):
+            saved = (parser.position, list(parser.pending))
+            parser.feed(html[offset:offset + chunksize])
+            offset += chunksize
+            yield from parser.drain()
+        parser.close()
+        yield from parser.drain()
+    except Exception:
+        # События недоразобранной порции отбрасываются, порция разбирается заново
+        (parser.position, pending) = saved
+        rest = ''.join(pending) + html[offset:]
+        parser.pending = []
+        parser.events = []
+        parser.anchor = None
+        for href in hrefpattern.findall(rest):
+            yield ('link', href, '')
+        parser.addtext(tagpattern.sub(' ', rest))
+        yield from parser.drain()
@@ -0,0 +1,118 @@
+import hashlib
+import numpy as np
+
+# Кэш 64-битных хэшей слов: словарь сайта невелик, а blake2b дорог
+wordhashes = {}
+
+
+def hash64(data):
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little')
+
+
+# Хэш загруженного содержимого страницы: по нему повторный обход узнаёт,
+# изменилась ли страница
+def contenthash(content):
+    return hashlib.blake2b(content, digest_size=16).digest()
+
+
+# Точный отпечаток текста: хэш последовательности слов
+def exacthash(words):
+    return hash64('\0'.join(words).encode('utf-8'))
+
+
+# SimHash текста по шинглам - последовательностям из shingle соседних слов
+# (слова из stopwords не учитываются). Каждый шингл голосует за биты своего
+# хэша с весом 1 + log(числа повторений). Отдельные слова для этого не
+# годятся: при ципфовском распределении частые слова задают отпечаток, и
+# у несвязанных страниц он почти одинаков. Общие шинглы бывают только у
+# страниц с общими кусками текста, поэтому у почти одинаковых текстов
+# отпечатки отличаются в немногих битах, а у разных - примерно в половине
+def simhash(words, stopwords=(), shingle=3):
+    hashes = []
+    for word in words:
+        if word in stopwords:
+            continue
+        h = wordhashes.get(word)
+        if h is None:
+            h = wordhashes[word] = hash64(word.encode('utf-8'))
+        hashes.append(h)
+    if not hashes:
+        return 0
+    hashes = np.array(hashes, dtype=np.uint64)
+    count = max(1, len(hashes) - shingle + 1)
+    # Хэш шингла: хэши слов, сдвинутые циклически на разное число бит, и
+    # перемешивание как в splitmix64
+    shingles = np.zeros(count, dtype=np.uint64)
+    for i in range(min(shingle, len(hashes))):
+        part = hashes[i:i + count]
+        r = np.uint64(21 * i)
+        shingles ^= (part << r) | (part >> (np.uint64(64) - r)) if i else part
+    shingles ^= shingles >> np.uint64(30)
+    shingles *= np.uint64(0xbf58476d1ce4e5b9)
+    shingles ^= shingles >> np.uint64(27)
+    shingles *= np.uint64(0x94d049bb133111eb)
+    shingles ^= shingles >> np.uint64(31)
+
+    (unique, counts) = np.unique(shingles, return_counts=True)
+    bits = np.unpackbits(unique.view(np.uint8).reshape(-1, 8), axis=1, bitorder='little')
+    weights = 1.0 + np.log(counts)
+    votes = weights @ (2 * bits.astype(np.float64) - 1)
+    return int(np.packbits(votes > 0, bitorder='little').view(np.uint64)[0])
+
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+
+# Отпечатки хранятся в integer SQLite, то есть со знаком
+def signed(h):
+    return h - (1 << 64) if h >= (1 << 63) else h
+
+
+def unsigned(v):
+    return v & ((1 << 64) - 1)
+
+
+# Индекс отпечатков для поиска страниц-дубликатов. 64 бита SimHash делятся
+# на threshold + 1 полос: если отпечатки отличаются не больше чем в threshold
+# битах, хотя бы одна полоса у них совпадает, поэтому сравнивать нужно только
+# страницы с общей полосой. Для коротких текстов (меньше minwords слов)
+# SimHash ненадёжен, и для них ищутся только точные совпадения
+class FingerprintIndex:
+    def __init__(self, threshold=8, minwords=20):
+        self.threshold = threshold
+        self.minwords = minwords
+        width = 64 // (threshold + 1)
+        self.bands = [(i * width, 64 if i == threshold else (i + 1) * width) for i in range(threshold + 1)]
+        self.exact = {}
+        self.tables = [{} for _ in self.bands]
+
+    def __len__(self):
+        return len(self.exact)
+
+    def bandkeys(self, sim):
+        return [(sim >> start) & ((1 << (end - start)) - 1) for (start, end) in self.bands]
+
+    def add(self, urlid, exact, sim):
+        self.exact.setdefault(exact, urlid)
+        for (table, key) in zip(self.tables, self.bandkeys(sim)):
+            table.setdefault(key, []).append((sim, urlid))
+
+    # urlid страницы, дубликатом которой является текст, и вид совпадения
+    # ('exact' или 'near'); (None, None), если такой страницы нет
+    def find(self, exact, sim, wordcount):
+        if exact in self.exact:
+            return self.exact[exact], 'exact'
+        if wordcount < self.minwords:
+            return None, None
+        best = None
+        for (table, key) in zip(self.tables, self.bandkeys(sim)):
+            for (other, urlid) in table.get(key, []):
+                distance = hamming(sim, other)
+                if distance <= self.threshold and (best is None or distance < best[0]):
+                    best = (distance, urlid)
+        return (best[1], 'near') if best is not None else (None, None)
+
+    def clear(self):
+        self.exact.clear()
+        self.tables = [{} for _ in self.bands]
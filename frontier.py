@@ -0,0 +1,219 @@
+import re
+import math
+import pickle
+import sqlite3
+import hashlib
+from collections import OrderedDict
+from urllib.parse import urlsplit, urlunsplit
+
+defaultports = {'http': 80, 'https': 443}
+escapepattern = re.compile(r'%[0-9a-fA-F]{2}')
+
+
+# Убирает из пути сегменты . и .. (RFC 3986, 5.2.4)
+def removedots(path):
+    segments = []
+    for segment in path.split('/'):
+        if segment == '..':
+            if len(segments) > 1:
+                segments.pop()
+        elif segment != '.':
+            segments.append(segment)
+    if path.endswith(('/.', '/..')):
+        segments.append('')
+    return '/'.join(segments)
+
+
+# Приведение URL к одному виду, чтобы одна страница не попадала в индекс под
+# разными адресами: схема и хост в нижнем регистре, без порта по умолчанию
+# и без фрагмента, пустой путь - '/', без сегментов . и .., экранирование
+# %xx в верхнем регистре. Параметры запроса не трогаются
+def normalizeurl(url):
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    if scheme not in defaultports:
+        return urlunsplit((parts.scheme, parts.netloc, parts.path, parts.query, ''))
+    try:
+        port = parts.port
+    except ValueError:
+        return urlunsplit((scheme, parts.netloc, parts.path, parts.query, ''))
+    host = parts.hostname or ''
+    if ':' in host:
+        host = f'[{host}]'
+    if parts.username is not None:
+        host = parts.netloc.rsplit('@', 1)[0] + '@' + host
+    netloc = host if port is None or port == defaultports[scheme] else f'{host}:{port}'
+    path = escapepattern.sub(lambda m: m.group().upper(), removedots(parts.path)) or '/'
+    return urlunsplit((scheme, netloc, path, parts.query, ''))
+
+
+# 64-битный хэш строки для фильтра Блума и дискового множества
+def urlhash(url):
+    return int.from_bytes(hashlib.blake2b(url.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+# Фильтр Блума на capacity элементов с долей ложных срабатываний errorrate.
+# k позиций получаются из двух половин одного 64-битного хэша
+class BloomFilter:
+    def __init__(self, capacity=1000000, errorrate=0.001):
+        self.size = max(8, int(-capacity * math.log(errorrate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, h):
+        (h1, h2) = (h & 0xffffffff, h >> 32)
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, h):
+        for p in self.positions(h):
+            self.bits[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, h):
+        return all(self.bits[p >> 3] & (1 << (p & 7)) for p in self.positions(h))
+
+
+# Множество просмотренных URL. Пока URL не больше memorylimit, это обычное
+# множество в памяти. Для очень больших обходов можно задать spillpath: тогда
+# при переполнении хэши URL переносятся в таблицу SQLite на диске, а фильтр
+# Блума по перенесённым хэшам отсекает обращения к диску для новых URL
+class SeenSet:
+    def __init__(self, spillpath=None, memorylimit=1000000, capacity=10000000, errorrate=0.001):
+        self.spillpath = spillpath
+        self.memorylimit = memorylimit
+        self.capacity = capacity
+        self.errorrate = errorrate
+        self.memory = set()
+        self.bloom = None
+        self.spill = None
+        self.spilled = 0
+
+    def __len__(self):
+        return len(self.memory) + self.spilled
+
+    def __contains__(self, url):
+        if url in self.memory:
+            return True
+        if self.bloom is None:
+            return False
+        h = urlhash(url)
+        if h not in self.bloom:
+            return False
+        return self.spill.execute("SELECT 1 FROM seen WHERE hash=?", (signed(h),)).fetchone() is not None
+
+    def add(self, url):
+        self.memory.add(url)
+        if self.spillpath is not None and len(self.memory) > self.memorylimit:
+            self.spillover()
+
+    def spillover(self):
+        if self.spill is None:
+            self.spill = sqlite3.connect(self.spillpath)
+            self.spill.execute('create table if not exists seen(hash integer primary key)')
+        if self.bloom is None:
+            self.bloom = BloomFilter(self.capacity, self.errorrate)
+        hashes = [urlhash(url) for url in self.memory]
+        cur = self.spill.executemany("INSERT OR IGNORE INTO seen(hash) VALUES (?)", [(signed(h),) for h in hashes])
+        self.spill.commit()
+        for h in hashes:
+            self.bloom.add(h)
+        self.spilled += cur.rowcount
+        self.memory = set()
+
+    def clear(self):
+        self.memory = set()
+        self.spilled = 0
+        self.bloom = None
+        if self.spill is not None:
+            self.spill.execute('DELETE FROM seen')
+            self.spill.commit()
+
+    # Состояние для сохранения: файл spillpath сохраняется сам
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['spill'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.bloom is not None:
+            self.spill = sqlite3.connect(self.spillpath)
+
+
+# Хэш в диапазоне integer SQLite
+def signed(h):
+    return h - (1 << 64) if h >= (1 << 63) else h
+
+
+# Фронтир обхода: какие URL уже проиндексированы и какие у URL rowid в
+# urllist, без чтения базы при обработке ссылок. ids - кэш urlid; при
+# cachesize=None в нём все URL из urllist, и URL не из кэша заведомо новый.
+# При ограниченном кэше все URL дополнительно хранятся в known, и чтение
+# нужно только для URL, вытесненного из кэша. Состояние сохраняется в файл и
+# восстанавливается, если обход с тех пор не менял базу (то же поколение
+# обхода; PageRank и признаки его не меняют)
+class Frontier:
+    def __init__(self, spillpath=None, memorylimit=1000000, cachesize=None):
+        self.cachesize = cachesize
+        self.ids = OrderedDict()
+        self.known = SeenSet(spillpath + '.known' if spillpath else None, memorylimit)
+        self.indexed = SeenSet(spillpath + '.indexed' if spillpath else None, memorylimit)
+        self.generation = None
+
+    # Заполнение по базе одним проходом по urllist и проиндексированным URL
+    def load(self, con, indexedurls):
+        self.clear()
+        for (urlid, url) in con.execute("SELECT rowid, url FROM urllist"):
+            self.remember(url, urlid)
+        for (url,) in indexedurls:
+            self.indexed.add(url)
+
+    def clear(self):
+        self.ids.clear()
+        self.known.clear()
+        self.indexed.clear()
+
+    def remember(self, url, urlid):
+        self.ids[url] = urlid
+        if self.cachesize is not None:
+            self.known.add(url)
+            self.ids.move_to_end(url)
+            if len(self.ids) > self.cachesize:
+                self.ids.popitem(last=False)
+
+    # rowid URL в urllist, новый URL добавляется
+    def geturlid(self, con, url):
+        urlid = self.ids.get(url)
+        if urlid is not None:
+            if self.cachesize is not None:
+                self.ids.move_to_end(url)
+            return urlid
+        if self.cachesize is not None and url in self.known:
+            row = con.execute("SELECT rowid FROM urllist WHERE url=?", (url,)).fetchone()
+            if row is not None:
+                self.remember(url, row[0])
+                return row[0]
+        urlid = con.execute("INSERT INTO urllist(url) VALUES (?)", (url,)).lastrowid
+        self.remember(url, urlid)
+        return urlid
+
+    def isindexed(self, url):
+        return url in self.indexed
+
+    def markindexed(self, url):
+        self.indexed.add(url)
+
+    def save(self, path, generation):
+        self.generation = generation
+        with open(path, 'wb') as f:
+            pickle.dump(self, f)
+
+
+# Фронтир из файла path, если он сохранён на поколении обхода generation,
+# иначе None
+def restorefrontier(path, generation):
+    try:
+        with open(path, 'rb') as f:
+            frontier = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+    return frontier if frontier.generation == generation else None
@@ -0,0 +1,185 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+
+# Пустой контекст для выключенных замеров: один общий объект, без часов
+class NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+nulltimer = NullTimer()
+
+
+# Замеры времени этапов, счётчики событий и число SQL-запросов по этапам.
+# Этапы вкладываются (query -> query.getmatches), время этапа включает время
+# вложенных, а SQL-запрос засчитывается самому внутреннему открытому этапу
+# своего потока. Выключенные замеры стоят одной проверки флага
+class Metrics:
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.timers = {}
+            self.counters = {}
+            self.statements = {}
+
+    def stages(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def timer(self, name):
+        if not self.enabled:
+            return nulltimer
+        return self.timed(name)
+
+    @contextmanager
+    def timed(self, name):
+        stack = self.stages()
+        stack.append(name)
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            stack.pop()
+            self.record(name, time.perf_counter() - start)
+
+    # Добавить к таймеру name уже измеренное время
+    def record(self, name, seconds):
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                self.timers[name] = [1, seconds, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+                timer[2] = max(timer[2], seconds)
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def sql(self, n=1):
+        if not self.enabled:
+            return
+        stack = self.stages()
+        stage = stack[-1] if stack else 'other'
+        with self.lock:
+            self.statements[stage] = self.statements.get(stage, 0) + n
+
+    # Итератор, время выдачи элементов которого идёт в таймер name. Нужен для
+    # генераторов, которые потребитель вычитывает по ходу своей работы
+    def timediter(self, name, iterable):
+        if not self.enabled:
+            return iterable
+        return self.timeditems(name, iterable)
+
+    def timeditems(self, name, iterable):
+        iterator = iter(iterable)
+        total = 0.0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    total += time.perf_counter() - start
+                yield item
+        finally:
+            self.record(name, total)
+
+    # Все замеры одним словарем
+    def snapshot(self):
+        with self.lock:
+            return {
+                'timers': dict([(name, {'count': c, 'seconds': s, 'max': m})
+                                for (name, (c, s, m)) in self.timers.items()]),
+                'counters': dict(self.counters),
+                'sql': dict(self.statements)
+            }
+
+    # Структурированный журнал: по строке JSON на каждый замер
+    def jsonlines(self):
+        data = self.snapshot()
+        now = time.time()
+        lines = []
+        for (name, timer) in sorted(data['timers'].items()):
+            lines.append(json.dumps(dict(ts=now, type='timer', name=name, **timer), ensure_ascii=False))
+        for (name, value) in sorted(data['counters'].items()):
+            lines.append(json.dumps(dict(ts=now, type='counter', name=name, value=value), ensure_ascii=False))
+        for (name, value) in sorted(data['sql'].items()):
+            lines.append(json.dumps(dict(ts=now, type='sql', name=name, value=value), ensure_ascii=False))
+        return '\n'.join(lines)
+
+    # Текстовый формат Prometheus
+    def prometheus(self, prefix='searchengine'):
+        data = self.snapshot()
+        lines = []
+        for (metric, kind, label, values) in [
+            ('stage_seconds_total', 'counter', 'stage', [(n, t['seconds']) for (n, t) in data['timers'].items()]),
+            ('stage_calls_total', 'counter', 'stage', [(n, t['count']) for (n, t) in data['timers'].items()]),
+            ('stage_seconds_max', 'gauge', 'stage', [(n, t['max']) for (n, t) in data['timers'].items()]),
+            ('sql_statements_total', 'counter', 'stage', list(data['sql'].items())),
+            ('events_total', 'counter', 'name', list(data['counters'].items()))
+        ]:
+            if not values:
+                continue
+            lines.append(f'# TYPE {prefix}_{metric} {kind}')
+            for (name, value) in sorted(values):
+                lines.append(f'{prefix}_{metric}{{{label}="{name}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+# Соединение SQLite, считающее выполненные через него запросы. Остальные
+# методы и свойства берутся у обёрнутого соединения
+class InstrumentedConnection:
+    def __init__(self, con, metrics):
+        self.con = con
+        self.metrics = metrics
+
+    def execute(self, *args):
+        self.metrics.sql()
+        return self.con.execute(*args)
+
+    def executemany(self, *args):
+        self.metrics.sql()
+        return self.con.executemany(*args)
+
+    def executescript(self, script):
+        self.metrics.sql()
+        return self.con.executescript(script)
+
+    def __getattr__(self, name):
+        return getattr(self.con, name)
+
+
+def connect(dbname, **kwargs):
+    return InstrumentedConnection(sqlite3.connect(dbname, **kwargs), metrics)
+
+
+# Общие для процесса замеры; включаются переменной окружения SEARCH_METRICS=1
+# или вызовом metrics.enable()
+metrics = Metrics(os.environ.get('SEARCH_METRICS', '') not in ('', '0'))
@@ -1,204 +1,694 @@
-from math import tanh
-import psycopg2
-
-
-def dtanh(y):
-    return 1.0 - y * y
-
-
-class searchnet:
-    def __init__(self):
-        try:
-            self.con = psycopg2.connect(f"dbname='nn' user='alexander' host='localhost' password='mint12345'")
-        except (Exception) as error:
-            print(error)
-
-    def __del__(self):
-        self.con.close()
-
-    def makeTables(self):
-        with self.con.cursor() as cur:
-            try:
-                cur.execute("create table hiddennode(rowid SERIAL PRIMARY KEY, create_key text)")
-                cur.execute("create table wordhidden(rowid SERIAL PRIMARY KEY, fromid int, toid int, strength float)")
-                cur.execute("create table hiddenurl(rowid SERIAL PRIMARY KEY, fromid int,toid int,strength float)")
-            except (Exception, psycopg2.DatabaseError) as error:
-                print(f"s.27: {error}");
-        self.con.commit()
-
-    def getStrength(self, fromID, toID, layer):
-        if layer == 0:
-            table = 'wordhidden'
-        else:
-            table = 'hiddenurl'
-
-        with self.con.cursor() as cur:
-            try:
-                cur.execute(f"select strength from {table} where fromid={fromID} and toid={toID}")
-                res = cur.fetchone()
-            except (Exception, psycopg2.DatabaseError) as error:
-                print(f"s.39: {error}");
-
-        if res is None:
-            if layer == 0:
-                return -0.2
-
-            if layer == 1:
-                return 0
-
-        return res[0]
-
-    def setStrength(self, fromID, toID, layer, strength):
-        if layer == 0:
-            table = 'wordhidden'
-        else:
-            table = 'hiddenurl'
-
-        with self.con.cursor() as cur:
-            try:
-                cur.execute(f"select rowid from {table} where fromid={fromID} and toid={toID}")
-                res = cur.fetchone()
-
-                if res is None:
-                    cur.execute(f"insert into {table}(fromid,toid,strength) values ({fromID},{toID},{strength})")
-                else:
-                    rowID = res[0]
-                    cur.execute(f"update {table} set strength={strength} where rowid={rowID}")
-            except (Exception, psycopg2.DatabaseError) as error:
-                print(f"s.66: {error}");
-
-    def generateHiddenNode(self, wordIDs, urls):
-        if len(wordIDs) > 3:
-            return None
-
-        createKey = "_".join(sorted([str(wi) for wi in wordIDs]))
-
-        with self.con.cursor() as cur:
-            try:
-                cur.execute(f"select rowid from hiddennode where create_key='{createKey}'")
-                res = cur.fetchone()
-            except (Exception, psycopg2.DatabaseError) as error:
-                print(f"s.81: {error}");
-
-            if res is None:
-                try:
-                    cur.execute(f"insert into hiddennode(create_key) values ('{createKey}') returning rowid")
-                    hiddenID = cur.fetchone()[0]
-                except (Exception, psycopg2.DatabaseError) as error:
-                    print(f"s.88: {error}");
-                
-                for wordID in wordIDs:
-                    self.setStrength(wordID, hiddenID, 0, 1.0 / len(wordIDs))
-
-                for urlID in urls:
-                    self.setStrength(hiddenID, urlID, 1, 0.1)
-            
-        self.con.commit()
-
-    def getAllHiddenIDs(self, wordIDs, urlIDs):
-        l1 = {}
-        with self.con.cursor() as cur:
-            try:
-                for wordID in wordIDs:
-                    cur.execute(f"select toID from wordhidden where fromid={wordID}")
-                    tmp = cur.fetchall()
-                    for row in tmp:
-                        l1[row[0]] = 1
-
-                for urlID in urlIDs:
-                    cur.execute(f"select fromid from hiddenurl where toID={urlID}")
-                    tmp = cur.fetchall()
-                    for row in tmp:
-                        l1[row[0]] = 1
-            except (Exception, psycopg2.DatabaseError) as error:
-                print(f"s.111: {error}");
-
-        return list(l1.keys())
-
-    def setupNetwork(self, wordIDs, urlIDs):
-        self.wordIDs = wordIDs
-        self.hiddenIDs = self.getAllHiddenIDs(wordIDs, urlIDs)
-        self.urlIDs = urlIDs
-
-        self.ai = [1.0] * len(self.wordIDs)
-        self.ah = [1.0] * len(self.hiddenIDs)
-        self.ao = [1.0] * len(self.urlIDs)
-
-        self.wi = [[self.getStrength(wordID, hiddenID, 0) for hiddenID in self.hiddenIDs] for wordID in self.wordIDs]
-        self.wo = [[self.getStrength(hiddenID, urlID, 1) for urlID in self.urlIDs] for hiddenID in self.hiddenIDs]
-
-    def feedforward(self):
-        for i in range(len(self.wordIDs)):
-            self.ai[i] = 1.0
-
-        for j in range(len(self.hiddenIDs)):
-            sum = 0.0
-
-            for i in range(len(self.wordIDs)):
-                sum = sum + self.ai[i] * self.wi[i][j]
-
-            self.ah[j] = tanh(sum)
-
-        for k in range(len(self.urlIDs)):
-            sum = 0.0
-
-            for j in range(len(self.hiddenIDs)):
-                sum = sum + self.ah[j] * self.wo[j][k]
-
-            self.ao[k] = tanh(sum)
-
-        return self.ao[:]
-
-    def getResult(self, wordIDs, urlIDs):
-        self.setupNetwork(wordIDs, urlIDs)
-        return self.feedforward()
-
-    def backPropogate(self, targets, N=0.5):
-        outputDeltas = [0.0] * len(self.urlIDs)
-
-        for k in range(len(self.urlIDs)):
-            error = targets[k] - self.ao[k]
-            outputDeltas[k] = dtanh(self.ao[k]) * error
-
-        hiddenDeltas = [0.0] * len(self.hiddenIDs)
-
-        for j in range(len(self.hiddenIDs)):
-            error = 0.0
-
-            for k in range(len(self.urlIDs)):
-                error = error + outputDeltas[k] * self.wo[j][k]
-
-            hiddenDeltas[j] = dtanh(self.ah[j]) * error
-
-        for j in range(len(self.hiddenIDs)):
-            for k in range(len(self.urlIDs)):
-                change = outputDeltas[k] * self.ah[j]
-                self.wo[j][k] = self.wo[j][k] + N * change
-
-        for i in range(len(self.wordIDs)):
-            for j in range(len(self.hiddenIDs)):
-                change = hiddenDeltas[j] * self.ai[i]
-                self.wi[i][j] = self.wi[i][j] + N * change
-
-    def trainQuery(self, wordIDs, urlIDs, selectedURL):
-        self.generateHiddenNode(wordIDs, urlIDs)
-
-        self.setupNetwork(wordIDs, urlIDs)
-        self.feedforward()
-
-        targets = [0.0] * len(urlIDs)
-        targets[urlIDs.index(selectedURL)] = 1.0
-        error = self.backPropogate(targets)
-
-        self.updateDataBase()
-
-    def updateDataBase(self):
-        for i in range(len(self.wordIDs)):
-            for j in range(len(self.hiddenIDs)):
-                self.setStrength(self.wordIDs[i], self.hiddenIDs[j], 0, self.wi[i][j])
-
-        for j in range(len(self.hiddenIDs)):
-            for k in range(len(self.urlIDs)):
-                self.setStrength(self.hiddenIDs[j], self.urlIDs[k], 1, self.wo[j][k])
-
-        self.con.commit()
+import os
+import copy
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+import numpy as np
+from instrument import metrics
+
+
+def dtanh(y):
+    return 1.0 - y * y
+
+
+# Поколения весов по хранилищам: меняются после обучения, по ним устаревает
+# кэш запросов. Общие для всех searchnet процесса, работающих с одной базой
+generations = {}
+generationsLock = threading.Lock()
+
+
+# Кэш подграфов сети для запросов. По набору слов хранятся связанные со
+# словами скрытые узлы и матрица весов слов к ним, по URL - связанные с URL
+# скрытые узлы и веса этих связей. Этого хватает, чтобы setupNetwork собрал
+# сеть без обращений к базе: у остальных связей вес по умолчанию. Объём
+# ограничен maxBytes, вытесняются давно не использованные записи. Запись
+# связей слова или URL удаляет только записи с этим словом или URL, а номер
+# epoch не даёт положить в кэш подграф, прочитанный до такой записи. Записи
+# других процессов кэш не видит
+class SubgraphCache:
+    def __init__(self, maxBytes=64 * 1024 * 1024):
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.byWord = {}
+        self.size = 0
+        self.epoch = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+        metrics.count('nn.cache.hit' if entry is not None else 'nn.cache.miss')
+        return entry[0] if entry is not None else None
+
+    # Ключ ('words', слова по возрастанию) или ('url', urlid), значение -
+    # кортеж массивов NumPy. epoch - номер, прочитанный до чтения из базы
+    def put(self, key, value, epoch):
+        size = 256 + sum(array.nbytes for array in value)
+        with self.lock:
+            if epoch != self.epoch or size > self.maxBytes or key in self.entries:
+                return
+            self.entries[key] = (value, size)
+            self.size += size
+            if key[0] == 'words':
+                for wordID in key[1]:
+                    self.byWord.setdefault(wordID, set()).add(key)
+            while self.size > self.maxBytes:
+                self.remove(next(iter(self.entries)))
+
+    def remove(self, key):
+        (value, size) = self.entries.pop(key)
+        self.size -= size
+        if key[0] == 'words':
+            for wordID in key[1]:
+                keys = self.byWord[wordID]
+                keys.discard(key)
+                if not keys:
+                    del self.byWord[wordID]
+
+    def invalidate(self, wordIDs=(), urlIDs=()):
+        with self.lock:
+            self.epoch += 1
+            keys = set(('url', urlID) for urlID in urlIDs)
+            for wordID in wordIDs:
+                keys.update(self.byWord.get(wordID, ()))
+            for key in keys:
+                if key in self.entries:
+                    self.remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.epoch += 1
+            self.entries.clear()
+            self.byWord.clear()
+            self.size = 0
+
+
+# Кэши подграфов по хранилищам, как и поколения, общие для всех searchnet
+# процесса: обучение в одном экземпляре сбрасывает кэш поискового
+subgraphCaches = {}
+
+
+def subgraphCache(name):
+    with generationsLock:
+        return subgraphCaches.setdefault(name, SubgraphCache())
+
+
+# Курсор SQLite, принимающий запросы в стиле psycopg2 (%s вместо ?), чтобы
+# searchnet писал один и тот же SQL для обоих хранилищ
+class SQLiteCursor:
+    def __init__(self, cur):
+        self.cur = cur
+
+    def execute(self, query, params=()):
+        metrics.sql()
+        self.cur.execute(query.replace('%s', '?'), params)
+
+    def executemany(self, query, rows):
+        metrics.sql()
+        self.cur.executemany(query.replace('%s', '?'), rows)
+
+    def fetchone(self):
+        return self.cur.fetchone()
+
+    def fetchall(self):
+        return self.cur.fetchall()
+
+    # Вставка строки с возвратом её идентификатора
+    def insertId(self, query, params=()):
+        self.execute(query, params)
+        return self.cur.lastrowid
+
+
+# Встроенное хранилище весов: файл SQLite без сетевых обращений. У каждого
+# потока своё соединение; WAL позволяет читать параллельно с записью
+class SQLiteStorage:
+    serial = 'INTEGER PRIMARY KEY'
+
+    def __init__(self, path='nn.db'):
+        self.path = path
+        self.name = path
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+
+    def connection(self):
+        con = getattr(self.local, 'con', None)
+        if con is None:
+            con = sqlite3.connect(self.path, cached_statements=256, check_same_thread=False)
+            con.execute('pragma journal_mode=WAL')
+            con.execute('pragma synchronous=NORMAL')
+            con.execute('pragma cache_size=-16000')
+            con.execute('pragma temp_store=MEMORY')
+            con.execute('pragma mmap_size=268435456')
+            self.local.con = con
+            with self.lock:
+                self.connections.append(con)
+        return con
+
+    # Транзакция: фиксация при успехе, откат при ошибке
+    @contextmanager
+    def transaction(self):
+        con = self.connection()
+        try:
+            yield SQLiteCursor(con.cursor())
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+
+    def close(self):
+        with self.lock:
+            for con in self.connections:
+                con.close()
+            self.connections = []
+
+
+class PostgresCursor:
+    def __init__(self, cur):
+        self.cur = cur
+
+    def execute(self, query, params=()):
+        metrics.sql()
+        self.cur.execute(query, params)
+
+    def executemany(self, query, rows):
+        metrics.sql()
+        self.cur.executemany(query, rows)
+
+    def fetchone(self):
+        return self.cur.fetchone()
+
+    def fetchall(self):
+        return self.cur.fetchall()
+
+    def insertId(self, query, params=()):
+        metrics.sql()
+        self.cur.execute(query + ' returning rowid', params)
+        return self.cur.fetchone()[0]
+
+
+# Хранилище весов в PostgreSQL через пул соединений: каждая транзакция берёт
+# своё соединение, поэтому несколько поисковиков могут работать параллельно
+class PostgresStorage:
+    serial = 'SERIAL PRIMARY KEY'
+
+    def __init__(self, dsn, minconn=1, maxconn=8):
+        import psycopg2.pool
+        self.name = dsn
+        self.pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, dsn)
+
+    @contextmanager
+    def transaction(self):
+        con = self.pool.getconn()
+        try:
+            with con.cursor() as cur:
+                yield PostgresCursor(cur)
+            con.commit()
+        except Exception:
+            con.rollback()
+            raise
+        finally:
+            self.pool.putconn(con)
+
+    def close(self):
+        self.pool.closeall()
+
+
+# Выбор хранилища по настройке: backend 'sqlite' или 'postgres', по умолчанию
+# из переменной окружения NN_BACKEND; для PostgreSQL dbname - строка DSN
+# (или NN_DSN)
+def openStorage(dbname=None, backend=None):
+    backend = backend or os.environ.get('NN_BACKEND', 'sqlite')
+    if backend == 'postgres':
+        return PostgresStorage(dbname or os.environ.get('NN_DSN', "dbname='nn' host='localhost'"))
+    if backend == 'sqlite':
+        return SQLiteStorage(dbname or 'nn.db')
+    raise ValueError(f"Неизвестное хранилище весов: {backend}")
+
+
+class searchnet:
+    def __init__(self, dbname=None, backend=None):
+        self.ownsStore = True
+        self.store = openStorage(dbname, backend)
+        self.subgraphs = subgraphCache(self.store.name)
+        self.makeTables()
+
+    def __del__(self):
+        if hasattr(self, 'store') and self.ownsStore:
+            self.store.close()
+
+    # Экземпляр для другого потока: то же хранилище и кэш подграфов, но своё
+    # состояние сети, которое setupNetwork и feedforward хранят в объекте
+    def fork(self):
+        net = copy.copy(self)
+        net.ownsStore = False
+        return net
+
+    @property
+    def generation(self):
+        return generations.get(self.store.name, 0)
+
+    def bumpGeneration(self):
+        with generationsLock:
+            generations[self.store.name] = generations.get(self.store.name, 0) + 1
+
+    def makeTables(self):
+        try:
+            with self.store.transaction() as cur:
+                cur.execute(f"create table if not exists hiddennode(rowid {self.store.serial}, create_key text)")
+                cur.execute(f"create table if not exists wordhidden(rowid {self.store.serial}, fromid int, toid int, strength float)")
+                cur.execute(f"create table if not exists hiddenurl(rowid {self.store.serial}, fromid int,toid int,strength float)")
+                # Уникальные ключи связей нужны для пакетной записи через upsert
+                cur.execute("create unique index if not exists wordhiddenidx on wordhidden(fromid, toid)")
+                cur.execute("create unique index if not exists hiddenurlidx on hiddenurl(fromid, toid)")
+                cur.execute("create unique index if not exists hiddennodeidx on hiddennode(create_key)")
+        except Exception as error:
+            print(f"s.27: {error}");
+
+    # Транзакция записи весов. setStrengths отмечает в курсоре слова и URL,
+    # связи которых меняются, а после фиксации их записи удаляются из кэша
+    # подграфов
+    @contextmanager
+    def update(self):
+        with self.store.transaction() as cur:
+            cur.touched = (set(), set())
+            yield cur
+        self.subgraphs.invalidate(*cur.touched)
+
+    def tableName(self, layer):
+        if layer == 0:
+            return 'wordhidden'
+        return 'hiddenurl'
+
+    # Сила связи по умолчанию, если строки в базе нет
+    def defaultStrength(self, layer):
+        if layer == 0:
+            return -0.2
+        return 0
+
+    def getStrength(self, fromID, toID, layer):
+        return self.getStrengths([fromID], [toID], layer).get((fromID, toID), self.defaultStrength(layer))
+
+    # Все известные силы связей между fromIDs и toIDs одним запросом:
+    # словарь {(fromid, toid): strength}
+    def getStrengths(self, fromIDs, toIDs, layer):
+        if not fromIDs or not toIDs:
+            return {}
+        fromIDs = list(fromIDs)
+        toIDs = list(toIDs)
+        fromMarks = ','.join(['%s'] * len(fromIDs))
+        toMarks = ','.join(['%s'] * len(toIDs))
+        with self.store.transaction() as cur:
+            cur.execute(f"select fromid, toid, strength from {self.tableName(layer)} "
+                        f"where fromid in ({fromMarks}) and toid in ({toMarks})", fromIDs + toIDs)
+            res = cur.fetchall()
+        return dict([((fromID, toID), strength) for (fromID, toID, strength) in res])
+
+    def setStrength(self, fromID, toID, layer, strength):
+        with self.update() as cur:
+            self.setStrengths(cur, [(fromID, toID, strength)], layer)
+
+    # Пакетная запись связей [(fromid, toid, strength)] одним upsert
+    # в рамках транзакции update, которой принадлежит курсор cur
+    def setStrengths(self, cur, rows, layer):
+        if not rows:
+            return
+        cur.touched[layer].update(row[0] if layer == 0 else row[1] for row in rows)
+        cur.executemany(f"insert into {self.tableName(layer)}(fromid,toid,strength) values (%s,%s,%s) "
+                        f"on conflict (fromid, toid) do update set strength=excluded.strength", rows)
+
+    def generateHiddenNode(self, wordIDs, urls):
+        with self.update() as cur:
+            self.addHiddenNode(cur, wordIDs, urls)
+
+    # Создание скрытого узла для сочетания слов в транзакции курсора cur.
+    # Возвращает (id узла, начальные связи слой 0, слой 1); None, если узел
+    # не нужен или уже есть
+    def addHiddenNode(self, cur, wordIDs, urls):
+        if len(wordIDs) > 3:
+            return None
+
+        createKey = "_".join(sorted([str(wi) for wi in wordIDs]))
+        cur.execute("select rowid from hiddennode where create_key=%s", (createKey,))
+        if cur.fetchone() is not None:
+            return None
+
+        hiddenID = cur.insertId("insert into hiddennode(create_key) values (%s)", (createKey,))
+        inputs = [(wordID, hiddenID, 1.0 / len(wordIDs)) for wordID in wordIDs]
+        outputs = [(hiddenID, urlID, 0.1) for urlID in urls]
+        self.setStrengths(cur, inputs, 0)
+        self.setStrengths(cur, outputs, 1)
+        return hiddenID, inputs, outputs
+
+    def getAllHiddenIDs(self, wordIDs, urlIDs):
+        l1 = {}
+        with self.store.transaction() as cur:
+            if wordIDs:
+                cur.execute(f"select toid from wordhidden where fromid in ({','.join(['%s'] * len(wordIDs))})",
+                            list(wordIDs))
+                for row in cur.fetchall():
+                    l1[row[0]] = 1
+
+            if urlIDs:
+                cur.execute(f"select fromid from hiddenurl where toid in ({','.join(['%s'] * len(urlIDs))})",
+                            list(urlIDs))
+                for row in cur.fetchall():
+                    l1[row[0]] = 1
+
+        return list(l1.keys())
+
+    # Матрица сил связей слоя по одному запросу; отсутствующие связи
+    # получают значение по умолчанию
+    def loadMatrix(self, fromIDs, toIDs, layer):
+        known = self.getStrengths(fromIDs, toIDs, layer)
+        default = self.defaultStrength(layer)
+        return np.array([[known.get((fromID, toID), default) for toID in toIDs] for fromID in fromIDs],
+                        dtype=float).reshape(len(fromIDs), len(toIDs))
+
+    # Подграф слов запроса из кэша или из базы: (слова по возрастанию,
+    # связанные с ними скрытые узлы, матрица весов слова x эти узлы)
+    def getWordSubgraph(self, wordIDs):
+        words = tuple(sorted(set(wordIDs)))
+        key = ('words', words)
+        value = self.subgraphs.get(key)
+        if value is None:
+            epoch = self.subgraphs.epoch
+            hiddenIDs = self.getAllHiddenIDs(words, [])
+            value = (np.array(hiddenIDs, dtype=np.int64), self.loadMatrix(words, hiddenIDs, 0))
+            self.subgraphs.put(key, value, epoch)
+        return (words,) + value
+
+    # Для каждого URL: (связанные с ним скрытые узлы, веса связей). URL, которых
+    # нет в кэше, читаются одним запросом
+    def getURLSubgraphs(self, urlIDs):
+        result = {}
+        missing = []
+        for urlID in urlIDs:
+            value = self.subgraphs.get(('url', urlID))
+            if value is None:
+                missing.append(urlID)
+            else:
+                result[urlID] = value
+        if missing:
+            epoch = self.subgraphs.epoch
+            links = dict([(urlID, ([], [])) for urlID in missing])
+            with self.store.transaction() as cur:
+                cur.execute(f"select fromid, toid, strength from hiddenurl "
+                            f"where toid in ({','.join(['%s'] * len(missing))})", missing)
+                for (hiddenID, urlID, strength) in cur.fetchall():
+                    links[urlID][0].append(hiddenID)
+                    links[urlID][1].append(strength)
+            for (urlID, (hiddenIDs, strengths)) in links.items():
+                value = (np.array(hiddenIDs, dtype=np.int64), np.array(strengths, dtype=float))
+                self.subgraphs.put(('url', urlID), value, epoch)
+                result[urlID] = value
+        return [result[urlID] for urlID in urlIDs]
+
+    # Сеть собирается из подграфов слов и URL: скрытые узлы - связанные со
+    # словами, затем связанные только с URL. Связи, которых нет в подграфах,
+    # получают вес по умолчанию, как и при чтении из базы
+    def setupNetwork(self, wordIDs, urlIDs):
+        self.wordIDs = wordIDs
+        self.urlIDs = urlIDs
+        (words, wordHidden, wordWeights) = self.getWordSubgraph(wordIDs)
+        urlLinks = self.getURLSubgraphs(urlIDs)
+        hidden = dict.fromkeys(wordHidden.tolist())
+        for (hiddenIDs, strengths) in urlLinks:
+            hidden.update(dict.fromkeys(hiddenIDs.tolist()))
+        self.hiddenIDs = list(hidden)
+
+        # Состояние сети хранится матрицами NumPy: wi - слова x скрытые узлы,
+        # wo - скрытые узлы x URL. Копии исходных весов нужны, чтобы записать
+        # в базу только изменившиеся связи
+        self.ai = np.ones(len(self.wordIDs))
+        self.ah = np.ones(len(self.hiddenIDs))
+        self.ao = np.ones(len(self.urlIDs))
+
+        rows = dict([(wordID, i) for (i, wordID) in enumerate(words)])
+        self.wi = np.full((len(self.wordIDs), len(self.hiddenIDs)), self.defaultStrength(0), dtype=float)
+        self.wi[:, :len(wordHidden)] = wordWeights[[rows[wordID] for wordID in self.wordIDs]]
+        columns = dict([(hiddenID, j) for (j, hiddenID) in enumerate(self.hiddenIDs)])
+        self.wo = np.full((len(self.hiddenIDs), len(self.urlIDs)), self.defaultStrength(1), dtype=float)
+        for (k, (hiddenIDs, strengths)) in enumerate(urlLinks):
+            self.wo[[columns[hiddenID] for hiddenID in hiddenIDs.tolist()], k] = strengths
+        self.savedwi = self.wi.copy()
+        self.savedwo = self.wo.copy()
+
+    def feedforward(self):
+        self.ai[:] = 1.0
+        self.ah = np.tanh(self.ai @ self.wi)
+        self.ao = np.tanh(self.ah @ self.wo)
+        return self.ao.tolist()
+
+    def getResult(self, wordIDs, urlIDs):
+        with metrics.timer('nn.setupNetwork'):
+            self.setupNetwork(wordIDs, urlIDs)
+        with metrics.timer('nn.feedforward'):
+            return self.feedforward()
+
+    # Оценка сразу нескольких списков URL для одних и тех же слов: сеть строится
+    # один раз по объединению URL. Выход для URL не зависит от остальных URL
+    # списка - скрытые узлы, не связанные с URL, дают ему нулевой вклад
+    def getResults(self, wordIDs, urlIDLists):
+        urlIDs = list(dict.fromkeys(urlID for urlIDs in urlIDLists for urlID in urlIDs))
+        result = dict(zip(urlIDs, self.getResult(wordIDs, urlIDs)))
+        return [[result[urlID] for urlID in urlIDs] for urlIDs in urlIDLists]
+
+    def backPropogate(self, targets, N=0.5):
+        targets = np.asarray(targets, dtype=float)
+        outputDeltas = dtanh(self.ao) * (targets - self.ao)
+        hiddenDeltas = dtanh(self.ah) * (self.wo @ outputDeltas)
+
+        self.wo += N * np.outer(self.ah, outputDeltas)
+        self.wi += N * np.outer(self.ai, hiddenDeltas)
+
+    def trainQuery(self, wordIDs, urlIDs, selectedURL):
+        self.trainBatch([(wordIDs, urlIDs, selectedURL)])
+
+    # Обучение на пачке кликов [(wordIDs, urlIDs, selectedURL)] с тем же
+    # результатом, что и trainQuery по каждому клику по очереди. Все нужные
+    # веса загружаются один раз, обновления сливаются в памяти по связям
+    # скрытых узлов, а в базу одной транзакцией пишутся только изменившиеся
+    def trainBatch(self, events):
+        if not events:
+            return
+        allWords = list(dict.fromkeys(wordID for (wordIDs, urlIDs, selected) in events for wordID in wordIDs))
+        allURLs = list(dict.fromkeys(urlID for (wordIDs, urlIDs, selected) in events for urlID in urlIDs))
+        hiddenIDs = self.getAllHiddenIDs(allWords, allURLs)
+        weights = [self.getStrengths(allWords, hiddenIDs, 0), self.getStrengths(hiddenIDs, allURLs, 1)]
+        saved = [dict(weights[0]), dict(weights[1])]
+
+        # Какие скрытые узлы связаны с каждым словом и каждым URL
+        byWord = {}
+        byURL = {}
+        for (wordID, hiddenID) in weights[0]:
+            byWord.setdefault(wordID, {})[hiddenID] = 1
+        for (hiddenID, urlID) in weights[1]:
+            byURL.setdefault(urlID, {})[hiddenID] = 1
+
+        with self.update() as cur:
+            for (wordIDs, urlIDs, selectedURL) in events:
+                node = self.addHiddenNode(cur, wordIDs, urlIDs)
+                if node is not None:
+                    (hiddenID, inputs, outputs) = node
+                    for (wordID, hiddenID, strength) in inputs:
+                        weights[0][(wordID, hiddenID)] = strength
+                        saved[0][(wordID, hiddenID)] = strength
+                        byWord.setdefault(wordID, {})[hiddenID] = 1
+                    for (hiddenID, urlID, strength) in outputs:
+                        weights[1][(hiddenID, urlID)] = strength
+                        saved[1][(hiddenID, urlID)] = strength
+                        byURL.setdefault(urlID, {})[hiddenID] = 1
+
+                self.wordIDs = wordIDs
+                self.urlIDs = urlIDs
+                hidden = {}
+                for wordID in wordIDs:
+                    hidden.update(byWord.get(wordID, {}))
+                for urlID in urlIDs:
+                    hidden.update(byURL.get(urlID, {}))
+                self.hiddenIDs = list(hidden)
+
+                self.ai = np.ones(len(self.wordIDs))
+                self.wi = np.array([[weights[0].get((wordID, hiddenID), -0.2) for hiddenID in self.hiddenIDs]
+                                    for wordID in self.wordIDs]).reshape(len(self.wordIDs), len(self.hiddenIDs))
+                self.wo = np.array([[weights[1].get((hiddenID, urlID), 0) for urlID in self.urlIDs]
+                                    for hiddenID in self.hiddenIDs]).reshape(len(self.hiddenIDs), len(self.urlIDs))
+                before = (self.wi.copy(), self.wo.copy())
+                self.feedforward()
+
+                targets = [0.0] * len(urlIDs)
+                targets[urlIDs.index(selectedURL)] = 1.0
+                self.backPropogate(targets)
+
+                for (i, j) in zip(*np.nonzero(self.wi != before[0])):
+                    weights[0][(self.wordIDs[i], self.hiddenIDs[j])] = float(self.wi[i, j])
+                    byWord.setdefault(self.wordIDs[i], {})[self.hiddenIDs[j]] = 1
+                for (j, k) in zip(*np.nonzero(self.wo != before[1])):
+                    weights[1][(self.hiddenIDs[j], self.urlIDs[k])] = float(self.wo[j, k])
+                    byURL.setdefault(self.urlIDs[k], {})[self.hiddenIDs[j]] = 1
+
+            for layer in (0, 1):
+                rows = [(fromID, toID, strength) for ((fromID, toID), strength) in weights[layer].items()
+                        if saved[layer].get((fromID, toID)) != strength]
+                self.setStrengths(cur, rows, layer)
+        self.bumpGeneration()
+
+    # Запись одним пакетом только тех весов, что изменились после setupNetwork
+    def updateDataBase(self):
+        with self.update() as cur:
+            rows = [(self.wordIDs[i], self.hiddenIDs[j], float(self.wi[i, j]))
+                    for (i, j) in zip(*np.nonzero(self.wi != self.savedwi))]
+            self.setStrengths(cur, rows, 0)
+
+            rows = [(self.hiddenIDs[j], self.urlIDs[k], float(self.wo[j, k]))
+                    for (j, k) in zip(*np.nonzero(self.wo != self.savedwo))]
+            self.setStrengths(cur, rows, 1)
+
+        self.savedwi = self.wi.copy()
+        self.savedwo = self.wo.copy()
+
+
+# Долговременная очередь кликов в локальном файле SQLite. Поисковый запрос
+# платит только за добавление записи, обучение идёт позже в ClickTrainer
+class ClickQueue:
+    def __init__(self, path='clicks.db'):
+        self.path = path
+        self.local = threading.local()
+        con = self.connection()
+        con.execute("create table if not exists clicks(id integer primary key, wordids text, urlids text, selected integer)")
+        con.execute("create table if not exists failed(id integer primary key, wordids text, urlids text, selected integer, "
+                    "error text)")
+        con.commit()
+
+    def connection(self):
+        con = getattr(self.local, 'con', None)
+        if con is None:
+            con = sqlite3.connect(self.path)
+            con.execute('pragma journal_mode=WAL')
+            con.execute('pragma synchronous=NORMAL')
+            self.local.con = con
+        return con
+
+    # Клик, выбранный URL которого не входит в urlIDs, обучить нельзя
+    def append(self, wordIDs, urlIDs, selectedURL):
+        if selectedURL not in urlIDs:
+            raise ValueError(f"{selectedURL} нет среди {list(urlIDs)}")
+        con = self.connection()
+        con.execute("insert into clicks(wordids, urlids, selected) values (?, ?, ?)",
+                    (json.dumps(list(wordIDs)), json.dumps(list(urlIDs)), selectedURL))
+        con.commit()
+
+    # Самые старые limit кликов: [(id, wordIDs, urlIDs, selectedURL)]
+    def peek(self, limit=100):
+        rows = self.connection().execute(
+            "select id, wordids, urlids, selected from clicks order by id limit ?", (limit,)).fetchall()
+        return [(id, json.loads(wordIDs), json.loads(urlIDs), selected) for (id, wordIDs, urlIDs, selected) in rows]
+
+    # Удаление обработанных кликов до lastID включительно
+    def remove(self, lastID):
+        con = self.connection()
+        con.execute("delete from clicks where id<=?", (lastID,))
+        con.commit()
+
+    # Перенос кликов ids, на которых обучение не удалось, в таблицу failed,
+    # чтобы они не задерживали очередь
+    def quarantine(self, ids, error):
+        con = self.connection()
+        marks = ','.join('?' * len(ids))
+        con.execute(f"insert or replace into failed(id, wordids, urlids, selected, error) "
+                    f"select id, wordids, urlids, selected, ? from clicks where id in ({marks})", [str(error)] + list(ids))
+        con.execute(f"delete from clicks where id in ({marks})", list(ids))
+        con.commit()
+
+    def __len__(self):
+        return self.connection().execute("select count(*) from clicks").fetchone()[0]
+
+
+# Фоновый поток, который забирает клики из очереди пачками по batchSize и
+# обучает на них сеть через trainBatch. Клик удаляется из очереди только
+# после записи весов, поэтому при падении процесса он будет обучен повторно,
+# но не потерян. Если пачка не обучается, клики обучаются по одному, а те,
+# на которых обучение падает, переносятся в ClickQueue.quarantine и поток
+# продолжает работу. У потока должен быть свой экземпляр searchnet
+class ClickTrainer(threading.Thread):
+    def __init__(self, net, clicks, batchSize=100, interval=1.0):
+        super().__init__(daemon=True)
+        self.net = net
+        self.clicks = clicks
+        self.batchSize = batchSize
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            if not self.drain():
+                self.stopped.wait(self.interval)
+        while self.drain():
+            pass
+
+    # Обучение на одной пачке; возвращает число обработанных кликов
+    def drain(self):
+        events = self.clicks.peek(self.batchSize)
+        if not events:
+            return 0
+        try:
+            self.net.trainBatch([(wordIDs, urlIDs, selected) for (id, wordIDs, urlIDs, selected) in events])
+        except Exception as error:
+            print(f"Ошибка обучения на пачке кликов: {error}")
+            self.trainEach(events)
+        self.clicks.remove(events[-1][0])
+        return len(events)
+
+    def trainEach(self, events):
+        for (id, wordIDs, urlIDs, selected) in events:
+            try:
+                self.net.trainBatch([(wordIDs, urlIDs, selected)])
+            except Exception as error:
+                print(f"Клик {id} перенесён в failed: {error}")
+                self.clicks.quarantine([id], error)
+
+    # Остановка после обучения на всех накопленных кликах
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+# Один и тот же замер для любого хранилища: rounds циклов оценки и обучения
+# на случайных запросах. Возвращает среднее время getResult и trainQuery в мс
+def benchmark(net, rounds=100, words=50, urls=500, perquery=20, seed=0):
+    import random
+    import time
+    rnd = random.Random(seed)
+    timings = {'getResult': [], 'trainQuery': []}
+    for i in range(rounds):
+        wordIDs = rnd.sample(range(1, words + 1), rnd.randrange(1, 4))
+        urlIDs = rnd.sample(range(1, urls + 1), perquery)
+
+        start = time.perf_counter()
+        net.getResult(wordIDs, urlIDs)
+        timings['getResult'].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        net.trainQuery(wordIDs, urlIDs, rnd.choice(urlIDs))
+        timings['trainQuery'].append(time.perf_counter() - start)
+    return dict([(name, 1000.0 * sum(values) / len(values)) for (name, values) in timings.items()])
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    parser = argparse.ArgumentParser(description='Замер скорости хранилища весов searchnet')
+    parser.add_argument('--backend', choices=['sqlite', 'postgres'], default=None)
+    parser.add_argument('--db', default=None, help='файл SQLite или DSN PostgreSQL')
+    parser.add_argument('--rounds', type=int, default=100)
+    args = parser.parse_args()
+    net = searchnet(args.db, args.backend)
+    print(json.dumps(benchmark(net, args.rounds)))
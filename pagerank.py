@@ -0,0 +1,215 @@
+import numpy as np
+
+
+# Граф ссылок, загруженный из базы одним проходом: URL пронумерованы подряд,
+# повторяющиеся ссылки удалены, входящие рёбра лежат в формате CSR
+class LinkGraph:
+    def __init__(self, con):
+        self.urlids = np.array([row[0] for row in con.execute("SELECT rowid FROM urllist ORDER BY rowid")],
+                               dtype=np.int64)
+        n = len(self.urlids)
+
+        edges = np.array(con.execute("SELECT DISTINCT fromid, toid FROM link").fetchall(), dtype=np.int64)
+        edges = edges.reshape(-1, 2)
+        src = self.positions(edges[:, 0])
+        dst = self.positions(edges[:, 1])
+        keep = (src >= 0) & (dst >= 0) & (src != dst)
+        src = src[keep]
+        dst = dst[keep]
+
+        # Рёбра, упорядоченные по получателю: indptr/indices - входящие ссылки
+        order = np.lexsort((src, dst))
+        self.src = src[order]
+        self.dst = dst[order]
+        self.indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.dst, minlength=n), out=self.indptr[1:])
+        self.indices = self.src
+        self.outdegree = np.bincount(self.src, minlength=n)
+
+    def __len__(self):
+        return len(self.urlids)
+
+    # Номера вершин для массива urlid (-1, если такого URL нет в urllist)
+    def positions(self, ids):
+        if len(self.urlids) == 0:
+            return np.full(len(ids), -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.urlids, ids), len(self.urlids) - 1)
+        return np.where(self.urlids[pos] == ids, pos, -1)
+
+
+# Степенной метод для PageRank в той же шкале, что и исходный расчёт
+# (pr = 0.15 + 0.85 * сумма вкладов). Ранг страниц без исходящих ссылок
+# равномерно распределяется по всем страницам, поэтому сумма рангов не утекает.
+# Возвращает (ранги, число итераций, невязку - максимальное изменение ранга)
+def poweriteration(graph, iterations=100, tolerance=1e-6, damping=0.85, start=None):
+    n = len(graph)
+    if n == 0:
+        return np.zeros(0), 0, 0.0
+
+    pr = np.ones(n) if start is None else np.array(start, dtype=np.float64)
+    dangling = graph.outdegree == 0
+    outdegree = np.maximum(graph.outdegree, 1)
+    residual = 0.0
+
+    for i in range(iterations):
+        contrib = np.where(dangling, 0.0, pr / outdegree)
+        incoming = np.bincount(graph.dst, weights=contrib[graph.src], minlength=n)
+        newpr = (1 - damping) + damping * (incoming + pr[dangling].sum() / n)
+        residual = float(np.abs(newpr - pr).max())
+        pr = newpr
+        if residual < tolerance:
+            return pr, i + 1, residual
+    return pr, iterations, residual
+
+
+# Запись рангов в таблицу pagerank одной транзакцией
+def savepagerank(con, graph, pr):
+    con.execute("DELETE FROM pagerank")
+    con.executemany("INSERT INTO pagerank(urlid, score) VALUES (?, ?)", zip(graph.urlids.tolist(), pr.tolist()))
+    dangling = graph.outdegree == 0
+    savemeta(con, float(pr[dangling].sum()), len(graph), graph.urlids[dangling].tolist())
+
+
+# Сохранение глобальных величин последнего расчёта, нужных для дообновления:
+# суммы рангов висячих страниц, числа страниц и списка висячих страниц.
+# Журнал изменений ссылок и недосчитанные страницы после полного расчёта
+# больше не нужны
+def savemeta(con, danglingsum, n, dangling):
+    con.execute("CREATE TABLE IF NOT EXISTS pagerankmeta(danglingsum real, n integer)")
+    con.execute("CREATE TABLE IF NOT EXISTS pagerankpending(urlid integer primary key)")
+    con.execute("CREATE TABLE IF NOT EXISTS pagerankdangling(urlid integer primary key)")
+    con.execute("DELETE FROM pagerankmeta")
+    con.execute("INSERT INTO pagerankmeta(danglingsum, n) VALUES (?, ?)", (danglingsum, n))
+    con.execute("DELETE FROM pagerankdangling")
+    con.executemany("INSERT INTO pagerankdangling(urlid) VALUES (?)", [(urlid,) for urlid in dangling])
+    con.execute("DELETE FROM linkchanges")
+    con.execute("DELETE FROM pagerankpending")
+    con.commit()
+
+
+# Дообновление PageRank после частичного обхода. Стартует с рангов из таблицы
+# pagerank и пересчитывает только страницы из журнала linkchanges, новые URL
+# и их соседей; изменения дальше распространяются, пока накопленный от
+# них сдвиг ранга соседней страницы больше threshold. Ранг висячих страниц делится
+# между всеми страницами, поэтому если сумма их рангов в расчёте на страницу
+# сдвинулась больше чем на threshold, меняются все ранги, и run отказывается
+# от дообновления в пользу полного расчёта
+class IncrementalPageRank:
+    def __init__(self, con, damping=0.85, threshold=1e-4):
+        self.con = con
+        self.damping = damping
+        self.threshold = threshold
+        self.scores = {}
+        self.inlinks = {}
+        self.outlinks = {}
+        self.updated = set()
+
+    # Есть ли данные предыдущего расчёта, от которых можно стартовать
+    def ready(self):
+        try:
+            self.con.execute("SELECT urlid FROM pagerankdangling LIMIT 1").fetchall()
+            return self.con.execute("SELECT danglingsum, n FROM pagerankmeta").fetchone() is not None
+        except Exception:
+            return False
+
+    def score(self, urlid):
+        if urlid not in self.scores:
+            row = self.con.execute("SELECT score FROM pagerank WHERE urlid=?", (urlid,)).fetchone()
+            self.scores[urlid] = row[0] if row is not None else 1.0
+        return self.scores[urlid]
+
+    def getinlinks(self, urlid):
+        if urlid not in self.inlinks:
+            self.inlinks[urlid] = [row[0] for row in self.con.execute(
+                "SELECT DISTINCT fromid FROM link WHERE toid=? AND fromid!=toid", (urlid,))]
+        return self.inlinks[urlid]
+
+    def getoutlinks(self, urlid):
+        if urlid not in self.outlinks:
+            self.outlinks[urlid] = [row[0] for row in self.con.execute(
+                "SELECT DISTINCT toid FROM link WHERE fromid=? AND fromid!=toid", (urlid,))]
+        return self.outlinks[urlid]
+
+    # Возвращает (число пересчётов вершин, наибольшее изменение ранга) или
+    # None, если нужен полный расчёт; в этом случае база не меняется. Если
+    # пересчёт остановлен на maxupdates, ещё не пересчитанные страницы
+    # сохраняются в pagerankpending, и следующий запуск продолжит с них
+    def run(self, maxupdates=1000000):
+        (danglingsum, n) = self.con.execute("SELECT danglingsum, n FROM pagerankmeta").fetchone()
+        (lastchange,) = self.con.execute("SELECT max(rowid) FROM linkchanges").fetchone()
+        changed = [row[0] for row in self.con.execute("SELECT DISTINCT urlid FROM linkchanges")]
+        self.con.execute("CREATE TABLE IF NOT EXISTS pagerankpending(urlid integer primary key)")
+
+        # URL, появившиеся после прошлого расчёта, стартуют с ранга 1.0.
+        # urllist только пополняется, поэтому они идут после последнего
+        # urlid из pagerank
+        (lastid,) = self.con.execute("SELECT coalesce(max(urlid), 0) FROM pagerank").fetchone()
+        newpages = [row[0] for row in self.con.execute("SELECT rowid FROM urllist WHERE rowid>?", (lastid,))]
+        uniform = danglingsum / n if n else 0.0
+        n += len(newpages)
+        if n == 0:
+            return None
+        for urlid in newpages:
+            self.scores[urlid] = 1.0
+            self.updated.add(urlid)
+
+        # Страницы, которые стали висячими или перестали быть ими, переносят
+        # свой ранг в сумму висячих рангов или из неё
+        flips = []
+        for urlid in set(changed).union(newpages):
+            wasdangling = self.con.execute(
+                "SELECT 1 FROM pagerankdangling WHERE urlid=?", (urlid,)).fetchone() is not None
+            isdangling = not self.getoutlinks(urlid)
+            if wasdangling != isdangling:
+                danglingsum += self.score(urlid) if isdangling else -self.score(urlid)
+                flips.append((urlid, isdangling))
+        if self.damping * abs(danglingsum / n - uniform) > self.threshold:
+            return None
+
+        pending = set(changed).union(newpages)
+        for urlid in changed:
+            pending.update(self.getoutlinks(urlid))
+        pending.update(row[0] for row in self.con.execute("SELECT urlid FROM pagerankpending"))
+
+        # residual - накопленный, но ещё не учтённый сдвиг ранга страницы от
+        # изменений рангов ссылающихся на неё страниц
+        residual = {}
+        updates = 0
+        maxdelta = 0.0
+        while pending and updates < maxupdates:
+            urlid = pending.pop()
+            residual.pop(urlid, None)
+            incoming = sum(self.score(v) / len(self.getoutlinks(v)) for v in self.getinlinks(urlid))
+            newpr = (1 - self.damping) + self.damping * (incoming + danglingsum / n)
+            delta = newpr - self.score(urlid)
+            updates += 1
+            maxdelta = max(maxdelta, abs(delta))
+            self.scores[urlid] = newpr
+            self.updated.add(urlid)
+            outlinks = self.getoutlinks(urlid)
+            if not outlinks:
+                danglingsum += delta
+                continue
+            push = self.damping * delta / len(outlinks)
+            for v in outlinks:
+                residual[v] = residual.get(v, 0.0) + push
+                if abs(residual[v]) > self.threshold:
+                    pending.add(v)
+        if self.damping * abs(danglingsum / n - uniform) > self.threshold:
+            return None
+
+        rows = [(urlid, self.scores[urlid]) for urlid in self.updated]
+        self.con.executemany("DELETE FROM pagerank WHERE urlid=?", [(urlid,) for (urlid, score) in rows])
+        self.con.executemany("INSERT INTO pagerank(urlid, score) VALUES (?, ?)", rows)
+        self.con.execute("DELETE FROM pagerankmeta")
+        self.con.execute("INSERT INTO pagerankmeta(danglingsum, n) VALUES (?, ?)", (danglingsum, n))
+        self.con.executemany("INSERT OR IGNORE INTO pagerankdangling(urlid) VALUES (?)",
+                             [(urlid,) for (urlid, isdangling) in flips if isdangling])
+        self.con.executemany("DELETE FROM pagerankdangling WHERE urlid=?",
+                             [(urlid,) for (urlid, isdangling) in flips if not isdangling])
+        if lastchange is not None:
+            self.con.execute("DELETE FROM linkchanges WHERE rowid<=?", (lastchange,))
+        self.con.execute("DELETE FROM pagerankpending")
+        self.con.executemany("INSERT INTO pagerankpending(urlid) VALUES (?)", [(urlid,) for urlid in pending])
+        self.con.commit()
+        return updates, maxdelta
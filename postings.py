@@ -0,0 +1,141 @@
+from bisect import bisect_left
+
+
+# Запись неотрицательного целого в формате varint (7 бит на байт)
+def encodevarint(value, out):
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decodevarints(data):
+    values = []
+    value = 0
+    shift = 0
+    for byte in data:
+        value |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            values.append(value)
+            value = 0
+            shift = 0
+    return values
+
+
+# Список документов слова [(urlid, [позиции]), ...], упорядоченный по urlid,
+# кодируется как число документов и для каждого документа разность urlid,
+# число позиций и разности позиций
+def encodepostings(docs):
+    out = bytearray()
+    encodevarint(len(docs), out)
+    lasturl = 0
+    for (urlid, positions) in docs:
+        encodevarint(urlid - lasturl, out)
+        lasturl = urlid
+        encodevarint(len(positions), out)
+        lastpos = 0
+        for pos in positions:
+            encodevarint(pos - lastpos, out)
+            lastpos = pos
+    return bytes(out)
+
+
+# Обратное преобразование: (упорядоченный список urlid, списки позиций)
+def decodepostings(data):
+    values = decodevarints(data)
+    urlids = []
+    positions = []
+    i = 1
+    urlid = 0
+    for _ in range(values[0] if values else 0):
+        urlid += values[i]
+        count = values[i + 1]
+        i += 2
+        pos = 0
+        plist = []
+        for delta in values[i:i + count]:
+            pos += delta
+            plist.append(pos)
+        i += count
+        urlids.append(urlid)
+        positions.append(plist)
+    return urlids, positions
+
+
+# Группировка строк (wordid, urlid, location), упорядоченных по всем трём
+# полям, в списки документов по словам
+def groupwordlocations(rows):
+    wordid = None
+    docs = []
+    for (w, urlid, location) in rows:
+        if w != wordid:
+            if wordid is not None:
+                yield wordid, docs
+            wordid = w
+            docs = []
+        if docs and docs[-1][0] == urlid:
+            docs[-1][1].append(location)
+        else:
+            docs.append((urlid, [location]))
+    if wordid is not None:
+        yield wordid, docs
+
+
+# Поиск первого индекса >= lo, где lst[индекс] >= value: сначала шаги
+# удваиваются, затем двоичный поиск в найденном отрезке
+def gallop(lst, value, lo):
+    step = 1
+    hi = lo
+    while hi < len(lst) and lst[hi] < value:
+        lo = hi + 1
+        hi += step
+        step *= 2
+    return bisect_left(lst, value, lo, min(hi, len(lst)))
+
+
+# Пересечение упорядоченных списков urlid. Возвращает [(urlid, (индексы в
+# каждом списке))]; обход ведётся по самому короткому списку
+def intersect(lists):
+    if not lists or any(len(lst) == 0 for lst in lists):
+        return []
+    order = sorted(range(len(lists)), key=lambda i: len(lists[i]))
+    driver = lists[order[0]]
+    pointers = [0] * len(lists)
+    result = []
+    for (di, urlid) in enumerate(driver):
+        pointers[order[0]] = di
+        found = True
+        for li in order[1:]:
+            lst = lists[li]
+            p = gallop(lst, urlid, pointers[li])
+            pointers[li] = p
+            if p == len(lst):
+                return result
+            if lst[p] != urlid:
+                found = False
+                break
+        if found:
+            result.append((urlid, tuple(pointers)))
+    return result
+
+
+# Начальные позиции фразы: списки позиций слов фразы в документе упорядочены,
+# поэтому каждый следующий список сливается с найденными началами со сдвигом
+# на номер слова во фразе
+def phrasestarts(lists):
+    starts = lists[0]
+    for (offset, lst) in enumerate(lists[1:], 1):
+        found = []
+        j = 0
+        for start in starts:
+            j = gallop(lst, start + offset, j)
+            if j == len(lst):
+                break
+            if lst[j] == start + offset:
+                found.append(start)
+        starts = found
+        if not starts:
+            break
+    return starts
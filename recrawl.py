@@ -0,0 +1,131 @@
+import gzip
+import time
+import urllib.request
+import urllib.error
+import extractor
+import fingerprint
+from instrument import metrics
+
+
+# Повторный обход проиндексированных страниц. Для каждой страницы в fetchmeta
+# хранятся ETag, Last-Modified, хэш содержимого, время последней загрузки и
+# изменения, число загрузок и изменений, оценка частоты изменений и интервал
+# до следующего визита. Запрос условный (If-None-Match, If-Modified-Since) и
+# принимает gzip. Изменившаяся страница переиндексируется на месте
+# (Crawler.indexpage с reindex=True), интервал для неё уменьшается вдвое, а
+# для неизменной растёт в growth раз в пределах [mininterval, maxinterval].
+# Ответ 304 или то же содержимое не трогает индекс: записываются только
+# новые сроки визитов, одним запросом на весь проход. Сведения о первой
+# загрузке записывает сам паук (Crawler.recordfetch), поэтому уже первый
+# визит условный. Страница, для которой хэша нет (проиндексирована до
+# появления fetchmeta), при первом визите переиндексируется
+class Recrawler:
+    def __init__(self, crawler, mininterval=3600, maxinterval=30 * 86400, growth=1.5, timeout=10, clock=time.time):
+        self.crawler = crawler
+        self.con = crawler.con
+        self.mininterval = mininterval
+        self.maxinterval = maxinterval
+        self.growth = growth
+        self.timeout = timeout
+        self.clock = clock
+        self.con.execute('create index if not exists fetchmetanextidx on fetchmeta(nextfetch)')
+        # Для удаления строк одной страницы при переиндексации
+        self.con.execute('create index if not exists wordlocationurlidx on wordlocation(urlid)')
+        self.con.execute('create index if not exists linkwordslinkidx on linkwords(linkid)')
+        self.con.commit()
+
+    # Постановка в расписание обработанных пауком страниц, которых там ещё
+    # нет, включая пропущенные дубликаты (они могли перестать совпадать с
+    # оригиналом) и страницы шардированного индекса: их первый повторный
+    # визит - сейчас
+    def schedule(self):
+        now = self.clock()
+        self.con.execute(
+            'INSERT INTO fetchmeta(urlid, fetches, changes) SELECT rowid, 0, 0 FROM urllist '
+            f'WHERE rowid NOT IN (SELECT urlid FROM fetchmeta) AND ({self.crawler.indexedpages})'
+        )
+        self.con.execute('UPDATE fetchmeta SET interval=?, nextfetch=? WHERE nextfetch IS NULL', (self.mininterval, now))
+        self.con.commit()
+
+    # Условная загрузка: (код ответа, содержимое, заголовки); код None -
+    # ошибка сети
+    def fetch(self, url, etag=None, lastmodified=None):
+        headers = {'User-Agent': 'Mozilla/5.0', 'Accept-Encoding': 'gzip'}
+        if etag:
+            headers['If-None-Match'] = etag
+        if lastmodified:
+            headers['If-Modified-Since'] = lastmodified
+        req = urllib.request.Request(url, headers=headers)
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as response:
+                content = response.read()
+                if response.headers.get('Content-Encoding', '').lower() == 'gzip':
+                    content = gzip.decompress(content)
+                return response.status, content, response.headers
+        except urllib.error.HTTPError as e:
+            return e.code, None, e.headers
+        except Exception as e:
+            print(f"Не могу открыть {url}: {e}")
+            return None, None, None
+
+    # Один проход по страницам, срок визита которых наступил (не больше
+    # limit). Возвращает статистику прохода
+    def run(self, limit=None):
+        now = self.clock()
+        due = self.con.execute(
+            'SELECT fetchmeta.urlid, url, etag, lastmodified, contenthash, firstfetch, fetches, changes, interval '
+            'FROM fetchmeta, urllist WHERE urllist.rowid=fetchmeta.urlid AND nextfetch<=? '
+            'ORDER BY nextfetch LIMIT ?', (now, -1 if limit is None else limit)
+        ).fetchall()
+
+        stats = {'checked': 0, 'notmodified': 0, 'unchanged': 0, 'reindexed': 0, 'errors': 0}
+        updates = []
+        for (urlid, url, etag, lastmodified, contenthash, firstfetch, fetches, changes, interval) in due:
+            stats['checked'] += 1
+            (status, content, headers) = self.fetch(url, etag, lastmodified)
+            now = self.clock()
+            changed = False
+            if status == 304:
+                stats['notmodified'] += 1
+                etag = headers.get('ETag', etag)
+            elif status == 200:
+                etag = headers.get('ETag')
+                lastmodified = headers.get('Last-Modified')
+                digest = fingerprint.contenthash(content)
+                if digest == contenthash:
+                    stats['unchanged'] += 1
+                else:
+                    print(f'Переиндексируется {url}')
+                    self.crawler.indexpage(url, extractor.extract(content), reindex=True)
+                    stats['reindexed'] += 1
+                    changed = contenthash is not None
+                    contenthash = digest
+            else:
+                # Ошибка: индекс не трогается, визит откладывается
+                stats['errors'] += 1
+
+            fetched = status in (200, 304)
+            if fetched:
+                fetches += 1
+                firstfetch = firstfetch if firstfetch is not None else now
+            if changed:
+                changes += 1
+                interval = max(self.mininterval, interval / 2)
+            else:
+                interval = min(self.maxinterval, interval * self.growth)
+            # Оценка частоты изменений: изменений в сутки с первой загрузки
+            changerate = changes * 86400.0 / max(now - firstfetch, 1.0) if firstfetch is not None else None
+            updates.append((etag, lastmodified, contenthash, firstfetch, now if fetched else None,
+                            now if changed else None, fetches, changes, changerate, interval, now + interval, urlid))
+
+        self.con.executemany(
+            'UPDATE fetchmeta SET etag=?, lastmodified=?, contenthash=?, firstfetch=?, lastfetch=coalesce(?, lastfetch), '
+            'lastchange=coalesce(?, lastchange), fetches=?, changes=?, changerate=coalesce(?, changerate), '
+            'interval=?, nextfetch=? WHERE urlid=?', updates
+        )
+        if self.crawler.bulk and stats['reindexed']:
+            self.crawler.flushindex()
+        self.con.commit()
+        for (name, value) in stats.items():
+            metrics.count('recrawl.' + name, value)
+        return stats
@@ -0,0 +1,263 @@
+import os
+import sys
+import time
+import random
+import sqlite3
+
+# Версия схемы индекса хранится в PRAGMA user_version: 0 - исходная схема
+# без типов и без индексов по wordlocation, 1 - текущая
+version = 1
+
+# Размер страницы новых баз
+pagesize = 8192
+
+# Строки индекса лежат в порядке первичного ключа: позиции одного слова
+# хранятся подряд, и выборка по wordid читает соседние страницы, а не
+# разбросанные по всей таблице строки
+wordlocation = ('create table {name}(wordid integer, urlid integer, location integer, '
+                'primary key (wordid, urlid, location)) without rowid')
+
+# urlid - псевдоним rowid, поиск ранга по urlid идёт по самой таблице
+pagerank = 'create table {name}(urlid integer primary key, score real)'
+
+# Таблицы текущей схемы. У urllist, wordlist и link остаётся rowid: это
+# urlid, wordid и linkid, на которые ссылаются остальные таблицы
+tables = [
+    ('urllist', 'create table {name}(url text)'),
+    ('wordlist', 'create table {name}(word text)'),
+    ('wordlocation', wordlocation),
+    ('link', 'create table {name}(fromid integer, toid integer)'),
+    ('linkwords', 'create table {name}(wordid integer, linkid integer)'),
+    ('pagerank', pagerank),
+    ('linkchanges', 'create table {name}(urlid integer)'),
+    ('pagerankmeta', 'create table {name}(danglingsum real, n integer)'),
+    ('pagerankpending', 'create table {name}(urlid integer primary key)'),
+    ('pagerankdangling', 'create table {name}(urlid integer primary key)'),
+    ('fingerprints', 'create table {name}(urlid integer primary key, exact integer, simhash integer, '
+                     'canonical integer)'),
+    ('fetchmeta', 'create table {name}(urlid integer primary key, etag text, lastmodified text, contenthash blob, '
+                  'firstfetch real, lastfetch real, lastchange real, fetches integer, changes integer, '
+                  'changerate real, interval real, nextfetch real)')
+]
+
+# Таблицы, которые строятся по таблицам индекса (признаки, текст ссылок,
+# postings). При пересоздании индекса они удаляются вместе с ним, иначе
+# ссылались бы на urlid старого индекса
+derivedtables = ['features', 'anchortext', 'postings']
+
+# Индексы по link покрывающие: входящие и исходящие ссылки страницы читаются
+# из индекса, без обращения к строкам таблицы
+indexes = [
+    'create index if not exists wordidx on wordlist(word)',
+    'create index if not exists urlidx on urllist(url)',
+    'create index if not exists wordlocationurlidx on wordlocation(urlid)',
+    'create index if not exists linktofromidx on link(toid, fromid)',
+    'create index if not exists linkfromtoidx on link(fromid, toid)',
+    'create index if not exists linkwordsidx on linkwords(wordid, linkid)',
+    'create index if not exists linkwordslinkidx on linkwords(linkid)'
+]
+
+# Индексы старой схемы, которые заменены покрывающими
+oldindexes = ['urltoidx', 'urlfromidx', 'pagerankidx']
+
+
+# Настройки соединения: WAL позволяет искать, пока паук пишет, mmap_size
+# отображает файл в память, cache_size - размер кэша страниц в КБ. Размер
+# страницы действует только для новой базы. Соединению только для чтения
+# (readonly=True) нужны лишь настройки чтения
+def setpragmas(con, readonly=False, mmapsize=256 * 1024 * 1024, cachesize=64 * 1024):
+    if not readonly:
+        con.execute(f'pragma page_size={pagesize}')
+        con.execute('pragma journal_mode=WAL')
+        con.execute('pragma synchronous=NORMAL')
+    con.execute(f'pragma cache_size=-{cachesize}')
+    con.execute('pragma temp_store=MEMORY')
+    con.execute(f'pragma mmap_size={mmapsize}')
+
+
+def getversion(con):
+    return con.execute('pragma user_version').fetchone()[0]
+
+
+# Пересоздание таблиц индекса в текущей схеме
+def createtables(con):
+    for name in derivedtables:
+        con.execute(f'drop table if exists {name}')
+    for (name, create) in tables:
+        con.execute(f'drop table if exists {name}')
+    for (name, create) in tables:
+        con.execute(create.format(name=name))
+    for create in indexes:
+        con.execute(create)
+    con.execute(f'pragma user_version={version}')
+
+
+def tablenames(con):
+    return set(row[0] for row in con.execute("SELECT name FROM sqlite_master WHERE type='table'"))
+
+
+# Совпадает ли таблица name с определением create. Имя не сравнивается:
+# после переименования SQLite хранит его в определении в кавычках
+def sameschema(con, name, create):
+    row = con.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name=?", (name,)).fetchone()
+    return row is not None and row[0][row[0].index('('):] == create[create.index('('):]
+
+
+# Размер файла базы с журналом WAL и объём занятых страниц
+def dbsize(dbname, con):
+    size = sum(os.path.getsize(path) for path in (dbname, dbname + '-wal') if os.path.exists(path))
+    pages = con.execute('pragma page_count').fetchone()[0]
+    free = con.execute('pragma freelist_count').fetchone()[0]
+    return {'bytes': size, 'used': (pages - free) * con.execute('pragma page_size').fetchone()[0]}
+
+
+# Запросы, которые поисковик и паук выполняют чаще всего, с параметрами
+queries = {
+    'isindexed': ('SELECT 1 FROM wordlocation WHERE urlid=? LIMIT 1', lambda s: (s['urlid'],)),
+    'getmatchrows': ('SELECT wordid, urlid, location FROM wordlocation WHERE wordid=? ORDER BY urlid, location',
+                     lambda s: (s['wordid'],)),
+    'twowords': ('SELECT w0.urlid, w0.location, w1.location FROM wordlocation w0, wordlocation w1 '
+                 'WHERE w0.wordid=? AND w1.wordid=? AND w0.urlid=w1.urlid', lambda s: (s['wordid'], s['other'])),
+    'pagerank': ('SELECT score FROM pagerank WHERE urlid=?', lambda s: (s['urlid'],)),
+    'inbound': ('SELECT COUNT(*) FROM link WHERE toid=?', lambda s: (s['urlid'],))
+}
+
+
+# Случайные слова и страницы, на которых сравнивается время запросов
+def samplequeries(con, samples=20, seed=0):
+    rng = random.Random(seed)
+    urlids = [row[0] for row in con.execute('SELECT rowid FROM urllist')]
+    wordids = [row[0] for row in con.execute('SELECT rowid FROM wordlist')]
+    if not urlids or not wordids:
+        return []
+    return [{'urlid': rng.choice(urlids), 'wordid': rng.choice(wordids), 'other': rng.choice(wordids)}
+            for _ in range(samples)]
+
+
+# Среднее время каждого запроса в мс
+def timequeries(con, samples):
+    timings = {}
+    for (name, (sql, params)) in queries.items():
+        if not samples:
+            break
+        start = time.perf_counter()
+        for sample in samples:
+            con.execute(sql, params(sample)).fetchall()
+        timings[name] = (time.perf_counter() - start) * 1000 / len(samples)
+    return timings
+
+
+def execute(con, *statements):
+    con.execute('BEGIN IMMEDIATE')
+    try:
+        for statement in statements:
+            con.execute(statement)
+        con.execute('COMMIT')
+    except Exception:
+        con.execute('ROLLBACK')
+        raise
+
+
+# Перестройка таблицы name в новой схеме create без остановки паука и
+# поиска. Новая таблица name_new заполняется пачками по batchsize строк по
+# rowid старой, каждая пачка - отдельная короткая транзакция. Пока идёт
+# копирование, триггеры повторяют в новой таблице все вставки, удаления и
+# изменения старой, сделанные любым соединением. В конце одной транзакцией
+# старая таблица заменяется новой. Прерванную перестройку можно запустить
+# заново; таблица, которая уже в схеме create, не перестраивается.
+# Возвращает число строк новой таблицы
+def rebuild(con, name, create, columns, key, batchsize=50000, progress=None):
+    new = name + '_new'
+    cols = ', '.join(columns)
+    values = ', '.join('new.' + column for column in columns)
+    match = ' AND '.join(f'{column}=old.{column}' for column in key)
+    triggers = [f'{name}_migrate_{event}' for event in ('insert', 'delete', 'update')]
+    if sameschema(con, name, create):
+        execute(con, *[f'drop trigger if exists {trigger}' for trigger in triggers], f'drop table if exists {new}')
+        return con.execute(f'SELECT COUNT(*) FROM {name}').fetchone()[0]
+    execute(con,
+            *[f'drop trigger if exists {trigger}' for trigger in triggers],
+            f'drop table if exists {new}',
+            create.format(name=new),
+            f'create trigger {name}_migrate_insert after insert on {name} begin '
+            f'insert or replace into {new}({cols}) values ({values}); end',
+            f'create trigger {name}_migrate_delete after delete on {name} begin '
+            f'delete from {new} where {match}; end',
+            f'create trigger {name}_migrate_update after update on {name} begin '
+            f'delete from {new} where {match}; insert or replace into {new}({cols}) values ({values}); end')
+
+    last = con.execute(f'SELECT max(rowid) FROM {name}').fetchone()[0] or 0
+    for start in range(0, last, batchsize):
+        con.execute('BEGIN IMMEDIATE')
+        con.execute(f'INSERT OR IGNORE INTO {new}({cols}) SELECT {cols} FROM {name} '
+                    f'WHERE rowid > ? AND rowid <= ?', (start, start + batchsize))
+        con.execute('COMMIT')
+        if progress is not None:
+            progress(name, min(start + batchsize, last), last)
+
+    execute(con,
+            *[f'drop trigger {trigger}' for trigger in triggers],
+            f'drop table {name}',
+            f'alter table {new} rename to {name}')
+    return con.execute(f'SELECT COUNT(*) FROM {name}').fetchone()[0]
+
+
+def printprogress(name, done, total):
+    print(f'{name}: {done} из {total}')
+
+
+# Обновление схемы базы индекса dbname до текущей версии без повторного
+# обхода. Старые таблицы wordlocation и pagerank перестраиваются функцией
+# rebuild, остальным добавляются индексы. Каждый шаг можно повторить, так
+# что прерванное обновление запускается заново с той же командой. С vacuum=True база в конце
+# пересобирается с размером страницы pagesize (это уже не онлайн: на время
+# VACUUM запись блокируется). Возвращает размер базы и среднее время
+# основных запросов до и после обновления
+def migrate(dbname, batchsize=50000, vacuum=False, samples=20, progress=printprogress):
+    con = sqlite3.connect(dbname, timeout=60, isolation_level=None)
+    try:
+        current = getversion(con)
+        report = {'from': current, 'to': version, 'rows': {}}
+        if current >= version:
+            report['to'] = current
+            return report
+        if 'wordlocation' not in tablenames(con):
+            raise ValueError(f'{dbname}: нет таблиц индекса')
+        con.execute('pragma journal_mode=WAL')
+        con.execute('pragma synchronous=NORMAL')
+        sample = samplequeries(con, samples)
+        report['before'] = dict(dbsize(dbname, con), timings=timequeries(con, sample))
+
+        start = time.perf_counter()
+        report['rows']['wordlocation'] = rebuild(con, 'wordlocation', wordlocation, ['wordid', 'urlid', 'location'],
+                                                 ['wordid', 'urlid', 'location'], batchsize, progress)
+        if 'pagerank' in tablenames(con):
+            report['rows']['pagerank'] = rebuild(con, 'pagerank', pagerank, ['urlid', 'score'], ['urlid'],
+                                                 batchsize, progress)
+        execute(con, *[f'drop index if exists {index}' for index in oldindexes], *indexes,
+                f'pragma user_version={version}')
+        con.execute('pragma wal_checkpoint(TRUNCATE)')
+        if vacuum:
+            con.execute('pragma journal_mode=DELETE')
+            con.execute(f'pragma page_size={pagesize}')
+            con.execute('VACUUM')
+            con.execute('pragma journal_mode=WAL')
+        con.execute('ANALYZE')
+        report['seconds'] = time.perf_counter() - start
+        report['after'] = dict(dbsize(dbname, con), timings=timequeries(con, sample))
+        return report
+    finally:
+        con.close()
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+    parser = argparse.ArgumentParser(description='Обновление схемы базы индекса')
+    parser.add_argument('db', help='база индекса')
+    parser.add_argument('--batch', type=int, default=50000, help='строк в одной транзакции копирования')
+    parser.add_argument('--vacuum', action='store_true', help='пересобрать базу после обновления')
+    parser.add_argument('--samples', type=int, default=20, help='запросов для замера времени')
+    args = parser.parse_args()
+    json.dump(migrate(args.db, args.batch, args.vacuum, args.samples), sys.stdout, ensure_ascii=False, indent=2)
+    print()
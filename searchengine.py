@@ -1,328 +1,1156 @@
-import urllib.request
-from bs4 import BeautifulSoup
-from urllib.parse import urljoin
-import sqlite3
-import re
-import nn
-
-mynet=nn.searchnet('nn.db')
-
-ignorewords = set(['the', 'of', 'to', 'and', 'a', 'in', 'is', 'it'])
-
-
-class Crawler:
-    # Инициализация паука, передав ему имя базы данных
-    def __init__(self, dbname):
-        self.con = sqlite3.connect(dbname)
-
-    def __del__(self):
-        self.con.close()
-
-    def dbcommit(self):
-        self.con.commit()
-
-    # Вспомогательная функция для добавления или получения идентификатора
-    def getentryid(self, table, field, value, createnew=True):
-        cur = self.con.execute(f"SELECT rowid FROM {table} WHERE {field}=?", (value,))
-        res = cur.fetchone()
-        if res is None:
-            if createnew:
-                cur = self.con.execute(f"INSERT INTO {table} ({field}) VALUES (?)", (value,))
-                return cur.lastrowid
-            else:
-                return None
-        else:
-            return res[0]
-
-    # Индексирование одной страницы
-    def addtoindex(self, url, soup):
-        if self.isindexed(url):
-            return
-        print(f'Индексируется {url}')
-
-        text = self.gettextonly(soup)
-        words = self.separatewords(text)
-        urlid = self.getentryid('urllist', 'url', url)
-
-        for i in range(len(words)):
-            word = words[i]
-            if word in ignorewords:
-                continue
-            wordid = self.getentryid('wordlist', 'word', word)
-            self.con.execute(
-                "INSERT INTO wordlocation(urlid, wordid, location) VALUES (?, ?, ?)",
-                (urlid, wordid, i)
-            )
-
-    # Извлечение текста из HTML-страницы
-    def gettextonly(self, soup):
-        v = soup.string
-        if v is None:
-            c = soup.contents
-            resulttext = ''
-            for t in c:
-                subtext = self.gettextonly(t)
-                resulttext += subtext + '\n'
-            return resulttext
-        else:
-            return v.strip()
-
-    # Разбиение текста на слова
-    def separatewords(self, text):
-        splitter = re.compile(r'\W+')
-        return [s.lower() for s in splitter.split(text) if s != '']
-
-    # Возвращает True, если данный URL уже проиндексирован
-    def isindexed(self, url):
-        u = self.con.execute("SELECT rowid FROM urllist WHERE url=?", (url,)).fetchone()
-        if u is not None:
-            v = self.con.execute("SELECT * FROM wordlocation WHERE urlid=?", (u[0],)).fetchone()
-            if v is not None:
-                return True
-        return False
-
-    # Добавление ссылки с одной страницы на другую
-    def addlinkref(self, urlFrom, urlTo, linkText):
-        fromid = self.getentryid('urllist', 'url', urlFrom)
-        toid = self.getentryid('urllist', 'url', urlTo)
-        if fromid == toid:
-            return
-        cur = self.con.execute("INSERT INTO link(fromid, toid) VALUES (?, ?)", (fromid, toid))
-        linkid = cur.lastrowid
-        words = self.separatewords(linkText)
-        for word in words:
-            if word in ignorewords:
-                continue
-            wordid = self.getentryid('wordlist', 'word', word)
-            self.con.execute("INSERT INTO linkwords(wordid, linkid) VALUES (?, ?)", (wordid, linkid))
-
-    # Поиск в ширину до заданной глубины, индексируя все встречающиеся по пути
-    def crawl(self, pages, depth=2):
-        for i in range(depth):
-            newpages = set()
-            for page in pages:
-                try:
-                    # Добавьте headers, если сайт блокирует
-                    req = urllib.request.Request(page, headers={'User-Agent': 'Mozilla/5.0'})
-                    c = urllib.request.urlopen(req)
-                except Exception as e:
-                    print(f"Не могу открыть {page}: {e}")
-                    continue
-                soup = BeautifulSoup(c.read(), "html.parser")
-                self.addtoindex(page, soup)
-
-                links = soup('a')
-                for link in links:
-                    if 'href' in link.attrs:
-                        url = urljoin(page, link['href'])
-                        if url.find("'") != -1:
-                            continue
-                        url = url.split('#')[0]  # удалить часть URL после #
-                        if url[0:4] == 'http' and not self.isindexed(url):
-                            newpages.add(url)
-                        linkText = self.gettextonly(link)
-                        self.addlinkref(page, url, linkText)
-                self.dbcommit()
-            pages = newpages
-
-    # Создание таблиц в базе данных
-    def createindextables(self):
-        self.con.execute('drop table if exists urllist')
-        self.con.execute('drop table if exists wordlist')
-        self.con.execute('drop table if exists wordlocation')
-        self.con.execute('drop table if exists link')
-        self.con.execute('drop table if exists linkwords')
-        self.con.execute('drop table if exists pagerank')
-
-        self.con.execute('create table urllist(url)')
-        self.con.execute('create table wordlist(word)')
-        self.con.execute('create table wordlocation(urlid, wordid, location)')
-        self.con.execute('create table link(fromid integer, toid integer)')
-        self.con.execute('create table linkwords(wordid, linkid)')
-        self.con.execute('create table pagerank(urlid integer, score real)')
-        self.con.execute('create index wordidx on wordlist(word)')
-        self.con.execute('create index urlidx on urllist(url)')
-        self.con.execute('create index urltoidx on link(toid)')
-        self.con.execute('create index urlfromidx on link(fromid)')
-        self.dbcommit()
-
-    def calculatepagerank(self, iterations=20):
-        # Инициализация PageRank = 1.0
-        self.con.execute("DELETE FROM pagerank")
-        self.con.execute("INSERT INTO pagerank(urlid, score) SELECT rowid, 1.0 FROM urllist")
-        self.dbcommit()
-
-        for i in range(iterations):
-            print(f"Итерация PageRank {i}")
-            for (urlid,) in self.con.execute("SELECT rowid FROM urllist"):
-                pr = 0.15
-                # Вклад всех ссылок
-                for (linker,) in self.con.execute("SELECT fromid FROM link WHERE toid=?", (urlid,)):
-                    linkingpr = self.con.execute("SELECT score FROM pagerank WHERE urlid=?", (linker,)).fetchone()[0]
-                    linkingcount = self.con.execute("SELECT COUNT(*) FROM link WHERE fromid=?", (linker,)).fetchone()[0]
-                    if linkingcount > 0:  # Избежать деления на 0
-                        pr += 0.85 * (linkingpr / linkingcount)
-                self.con.execute("UPDATE pagerank SET score=? WHERE urlid=?", (pr, urlid))
-            self.dbcommit()
-
-
-class Searcher:
-    def __init__(self, dbname):
-        self.con = sqlite3.connect(dbname)
-
-    def __del__(self):
-        self.con.close()
-
-    # Поиск совпадений для слов запроса
-    def getmatchrows(self, query):
-        fieldlist = 'w0.urlid'
-        tablelist = ''
-        clauselist = ''
-        wordids = []
-
-        words = query.split(' ')
-        tablenumber = 0
-
-        for word in words:
-            wordrow = self.con.execute("SELECT rowid FROM wordlist WHERE word=?", (word,)).fetchone()
-            if wordrow is not None:
-                wordid = wordrow[0]
-                wordids.append(wordid)
-                if tablenumber > 0:
-                    tablelist += ','
-                    clauselist += f' AND w{tablenumber - 1}.urlid=w{tablenumber}.urlid AND '
-                fieldlist += f', w{tablenumber}.location'
-                tablelist += f'wordlocation w{tablenumber}'
-                clauselist += f'w{tablenumber}.wordid={wordid}'
-                tablenumber += 1
-
-        if tablelist == '':  # Если нет слов, вернуть пустой результат
-            return [], []
-
-        fullquery = f"SELECT {fieldlist} FROM {tablelist} WHERE {clauselist}"
-        cur = self.con.execute(fullquery)
-        rows = [row for row in cur]
-        return rows, wordids
-
-    # Ранжирование результатов
-    def getscoredlist(self, rows, wordids):
-        totalscores = dict([(row[0], 0) for row in rows])
-        weights = [
-            (1.0, self.frequencyscore(rows)),
-            (1.0, self.locationscore(rows)),
-            (1.0, self.distancescore(rows)),
-            (1.0, self.inboundlinkscore(rows)),
-            (1.0, self.pagerankscore(rows)),
-            (1.0, self.linktextscore(rows, wordids)),
-            (1.0, self.nnscore(rows, wordids))
-        ]
-
-        for (weight, scores) in weights:
-            for url in totalscores:
-                totalscores[url] += weight * scores.get(url, 0)
-
-        return totalscores
-
-    def geturlname(self, id):
-        return self.con.execute("SELECT url FROM urllist WHERE rowid=?", (id,)).fetchone()[0]
-
-    # Выполнение запроса
-    def query(self, q):
-        rows, wordids = self.getmatchrows(q)
-        scores = self.getscoredlist(rows, wordids)
-        rankedscores = sorted([(score, url) for (url, score) in scores.items()], reverse=True)
-        for (score, urlid) in rankedscores[0:10]:
-            print(f"{score:.3f}\t{self.geturlname(urlid)}")
-        return wordids, [r[1] for r in rankedscores[0:10]]
-
-    def normalizescores(self, scores, smallIsBetter=0):
-        vsmall = 0.00001  # Предотвратить деление на нуль
-        if smallIsBetter:
-            minscore = min(scores.values()) if scores else vsmall
-            return dict([(u, float(minscore) / max(vsmall, scores[u])) for u in scores])
-        else:
-            maxscore = max(scores.values())
-            if maxscore == 0: maxscore = vsmall
-            return dict([(u, float(c) / maxscore) for (u, c) in scores.items()])
-
-    def frequencyscore(self, rows):
-        counts = dict([(row[0], 0) for row in rows])
-        for row in rows:
-            counts[row[0]] += 1
-        return self.normalizescores(counts)
-
-    def locationscore(self, rows):
-        locations = dict([(row[0], 1000000) for row in rows])
-        for row in rows:
-            loc = sum(row[1:])
-            if loc < locations[row[0]]:
-                locations[row[0]] = loc
-        return self.normalizescores(locations, smallIsBetter=1)
-
-    def distancescore(self, rows):
-        # Если есть только одно слово, любой документ выигрывает!
-        if len(rows[0]) <= 2:
-            return dict([(row[0], 1.0) for row in rows])
-
-        # Инициализировать словарь большими значениями
-        mindistance = dict([(row[0], 1000000) for row in rows])
-
-        for row in rows:
-            dist = sum([abs(row[i] - row[i-1]) for i in range(2, len(row))])
-            if dist < mindistance[row[0]]:
-                mindistance[row[0]] = dist
-        return self.normalizescores(mindistance, smallIsBetter=1)
-
-    def inboundlinkscore(self, rows):
-        uniqueurls = set([row[0] for row in rows])
-        inboundcount = dict([(u, self.con.execute(
-            'SELECT COUNT(*) FROM link WHERE toid=?', (u,)
-        ).fetchone()[0]) for u in uniqueurls])
-        return self.normalizescores(inboundcount)
-
-    def pagerankscore(self, rows):
-        pageranks = dict([(row[0], self.con.execute(
-            'SELECT score FROM pagerank WHERE urlid=?', (row[0],)
-        ).fetchone()[0]) for row in rows])
-        maxrank = max(pageranks.values())
-        normalizedscores = dict([(u, float(l) / maxrank) for (u, l) in pageranks.items()])
-        return normalizedscores
-
-    def linktextscore(self, rows, wordids):
-        linkscores = dict([(row[0], 0) for row in rows])
-        for wordid in wordids:
-            cur = self.con.execute(
-                'SELECT link.fromid, link.toid FROM linkwords, link '
-                'WHERE wordid=? AND linkwords.linkid=link.rowid', (wordid,)
-            )
-            for (fromid, toid) in cur:
-                if toid in linkscores:
-                    pr = self.con.execute(
-                        'SELECT score FROM pagerank WHERE urlid=?', (fromid,)
-                    ).fetchone()[0]
-                    linkscores[toid] += pr
-        maxscore = max(linkscores.values())
-        normalizedscores = dict([(u, float(l) / maxscore) for (u, l) in linkscores.items()])
-        return normalizedscores
-
-    def nnscore(self, rows, wordids):
-        # Получить уникальные идентификаторы URL в виде упорядоченного списка
-        urlids = [urlid for urlid in set([row[0] for row in rows])]
-        nnres = mynet.getResult(wordids, urlids)
-        scores = dict([(urlids[i], nnres[i]) for i in range(len(urlids))])
-        return self.normalizescores(scores)
-
-
-# Пример запуска
-if __name__ == "__main__":
-    crawler = Crawler("search.db")
-    # crawler.createindextables()  # Раскомментируйте для создания таблиц
-    # crawler.crawl(["https://www.woman.ru/forum/"], depth=2)  # Раскомментируйте для краулинга
-    # crawler.calculatepagerank()  # Раскомментируйте для расчёта PageRank
-    searcher = Searcher("search.db")
-    q = searcher.query("мужчина")
-
-    if q is not None:
-        (wordIDs, urlIDs) = q
-        mynet.trainQuery(wordIDs, urlIDs, urlIDs[0])
-
+import copy
+import urllib.request
+from urllib.parse import urljoin, urlsplit
+import sqlite3
+import re
+import sys
+import time
+import heapq
+import threading
+import queue
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import nn
+import pagerank
+import postings
+import extractor
+import frontier
+import fingerprint
+import schema
+from instrument import metrics
+import instrument
+
+mynet=nn.searchnet('nn.db')
+
+ignorewords = set(['the', 'of', 'to', 'and', 'a', 'in', 'is', 'it'])
+
+# Слово запроса или фраза в кавычках
+querypattern = re.compile(r'"([^"]*)"?|(\S+)')
+
+# Общий для процесса кэш слово -> wordid, отдельный для каждой базы данных
+wordidcache = {}
+
+
+# Поколение индекса: увеличивается при каждой фиксации изменений индекса,
+# PageRank или признаков, по нему устаревают закэшированные результаты.
+# С crawl=True увеличивается и поколение обхода 'crawl' - оно меняется только
+# вместе с urllist и набором проиндексированных страниц, и по нему
+# восстанавливается сохранённый фронтир
+def bumpgeneration(con, crawl=False):
+    con.execute("CREATE TABLE IF NOT EXISTS meta(key text primary key, value)")
+    for key in (('generation', 'crawl') if crawl else ('generation',)):
+        con.execute("INSERT OR IGNORE INTO meta(key, value) VALUES (?, 0)", (key,))
+        con.execute("UPDATE meta SET value=value+1 WHERE key=?", (key,))
+
+
+def getgeneration(con, key='generation'):
+    try:
+        row = con.execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+    except sqlite3.OperationalError:
+        return 0
+    return row[0] if row is not None else 0
+
+
+# Соединение с базой только для чтения. Закрыть его можно из любого потока
+def connectreadonly(dbname):
+    return instrument.connect(f'file:{urllib.request.pathname2url(dbname)}?mode=ro', uri=True,
+                              check_same_thread=False)
+
+
+# Кэш результатов запросов с вытеснением давно не использованных записей.
+# Размер ограничен числом записей и примерным объёмом в байтах, записи
+# могут устаревать через ttl секунд и всегда - при смене поколения
+class QueryCache:
+    def __init__(self, maxentries=1000, maxbytes=16 * 1024 * 1024, ttl=None):
+        self.maxentries = maxentries
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, generation):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                (gen, created, size, value) = entry
+                if gen == generation and (self.ttl is None or time.monotonic() - created <= self.ttl):
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self.discard(key)
+            self.misses += 1
+            return None
+
+    def put(self, key, generation, value):
+        size = self.sizeof(key, value)
+        with self.lock:
+            self.discard(key)
+            self.entries[key] = (generation, time.monotonic(), size, value)
+            self.bytes += size
+            while self.entries and (len(self.entries) > self.maxentries or self.bytes > self.maxbytes):
+                (oldkey, entry) = self.entries.popitem(last=False)
+                self.bytes -= entry[2]
+                self.evictions += 1
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    # Примерный объём записи: ключ, списки и строки результата
+    def sizeof(self, key, value):
+        (wordids, results) = value
+        size = sys.getsizeof(key) + sys.getsizeof(key[0]) + sys.getsizeof(wordids) + sys.getsizeof(results)
+        for (score, urlid, url) in results:
+            size += sys.getsizeof(url) + 100
+        return size + 8 * len(wordids)
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+# Таблица postings по строкам wordlocation той же базы
+def writepostings(con):
+    con.execute('drop table if exists postings')
+    con.execute('create table postings(wordid integer primary key, df integer, data blob)')
+    cur = con.execute("SELECT wordid, urlid, location FROM wordlocation ORDER BY wordid, urlid, location")
+    batch = []
+    for (wordid, docs) in postings.groupwordlocations(cur):
+        batch.append((wordid, len(docs), postings.encodepostings(docs)))
+        if len(batch) >= 1000:
+            con.executemany("INSERT INTO postings(wordid, df, data) VALUES (?, ?, ?)", batch)
+            batch = []
+    con.executemany("INSERT INTO postings(wordid, df, data) VALUES (?, ?, ?)", batch)
+    con.commit()
+
+
+# Ограничение вежливости: не больше perhost одновременных запросов к одному
+# хосту и не чаще одного запроса в delay секунд
+class HostLimiter:
+    def __init__(self, perhost=2, delay=0.0):
+        self.perhost = perhost
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.semaphores = {}
+        self.nextfetch = {}
+
+    def acquire(self, host):
+        with self.lock:
+            sem = self.semaphores.setdefault(host, threading.Semaphore(self.perhost))
+        sem.acquire()
+        if self.delay > 0:
+            with self.lock:
+                now = time.monotonic()
+                slot = max(now, self.nextfetch.get(host, 0.0))
+                self.nextfetch[host] = slot + self.delay
+            if slot > now:
+                time.sleep(slot - now)
+
+    def release(self, host):
+        self.semaphores[host].release()
+
+
+class Crawler:
+    # Инициализация паука, передав ему имя базы данных.
+    # В пакетном режиме (bulk=True) строки wordlocation и linkwords копятся
+    # в памяти и записываются одной транзакцией раз в flushpages страниц.
+    # frontierpath - файл, в котором фронтир сохраняется после обхода и из
+    # которого восстанавливается при следующем запуске; spillpath и cachesize
+    # передаются frontier.Frontier для очень больших обходов.
+    # С dedup=True страницы, текст которых совпадает с уже проиндексированной
+    # страницей точно или с точностью до hamming бит SimHash, не индексируются
+    def __init__(self, dbname, bulk=False, flushpages=100, frontierpath=None, spillpath=None, cachesize=None,
+                 dedup=False, hamming=8):
+        self.con = instrument.connect(dbname)
+        schema.setpragmas(self.con)
+        self.con.execute('create table if not exists linkchanges(urlid integer)')
+        self.con.execute('create table if not exists fingerprints'
+                         '(urlid integer primary key, exact integer, simhash integer, canonical integer)')
+        self.con.execute('create table if not exists fetchmeta'
+                         '(urlid integer primary key, etag text, lastmodified text, contenthash blob, firstfetch real, '
+                         'lastfetch real, lastchange real, fetches integer, changes integer, changerate real, '
+                         'interval real, nextfetch real)')
+        self.dbname = dbname
+        self.bulk = bulk
+        self.flushpages = flushpages
+        self.wordids = wordidcache.setdefault(dbname, {})
+        self.locationbuffer = []
+        self.linkwordsbuffer = []
+        self.pendingurls = set()
+        self.pendingpages = 0
+        self.changedurls = set()
+        self.postingsvalid = True
+        self.indexstats = {'pages': 0, 'words': 0, 'seconds': 0.0}
+        self.dedup = dedup
+        self.fingerprints = fingerprint.FingerprintIndex(hamming)
+        self.dupstats = {'pages': 0, 'exact': 0, 'near': 0, 'rows': 0}
+        if dedup:
+            self.loadfingerprints()
+        self.frontierpath = frontierpath
+        self.frontier = None
+        if frontierpath is not None:
+            self.frontier = frontier.restorefrontier(frontierpath, getgeneration(self.con, 'crawl'))
+        if self.frontier is None:
+            self.frontier = frontier.Frontier(spillpath, cachesize=cachesize)
+            self.loadfrontier()
+
+    def __del__(self):
+        self.con.close()
+
+    def dbcommit(self):
+        if self.bulk:
+            if self.pendingpages < self.flushpages:
+                return
+            self.flushindex()
+            return
+        with metrics.timer('crawl.commit'):
+            self.flushchanges()
+            bumpgeneration(self.con, crawl=True)
+            self.con.commit()
+
+    # Запись журнала страниц, у которых изменились входящие или исходящие
+    # ссылки; по нему calculatepagerank(incremental=True) дообновляет ранги
+    def flushchanges(self):
+        if self.changedurls:
+            self.con.executemany("INSERT INTO linkchanges(urlid) VALUES (?)", [(u,) for u in self.changedurls])
+            self.changedurls.clear()
+
+    # Запись накопленных строк через executemany и фиксация транзакции
+    def flushindex(self):
+        start = time.perf_counter()
+        with metrics.timer('crawl.commit'):
+            if self.locationbuffer:
+                self.con.executemany(
+                    "INSERT INTO wordlocation(urlid, wordid, location) VALUES (?, ?, ?)",
+                    self.locationbuffer
+                )
+            if self.linkwordsbuffer:
+                self.con.executemany("INSERT INTO linkwords(wordid, linkid) VALUES (?, ?)", self.linkwordsbuffer)
+            self.flushchanges()
+            bumpgeneration(self.con, crawl=True)
+            self.con.commit()
+        self.locationbuffer = []
+        self.linkwordsbuffer = []
+        self.pendingurls.clear()
+        self.pendingpages = 0
+        self.indexstats['seconds'] += time.perf_counter() - start
+
+    # Заполнение фронтира по базе
+    def loadfrontier(self):
+        tables = set(row[0] for row in self.con.execute("SELECT name FROM sqlite_master WHERE type='table'"))
+        if 'urllist' in tables:
+            self.frontier.load(self.con, self.getindexedurls())
+
+    # Условие на rowid в urllist: слова страницы уже есть в индексе или она
+    # пропущена как дубликат
+    indexedpages = ("rowid IN (SELECT DISTINCT urlid FROM wordlocation) "
+                    "OR rowid IN (SELECT urlid FROM fingerprints WHERE canonical IS NOT NULL)")
+
+    # URL проиндексированных страниц и пропущенных дубликатов
+    def getindexedurls(self):
+        return self.con.execute(f"SELECT url FROM urllist WHERE {self.indexedpages}")
+
+    # Отпечатки проиндексированных страниц (дубликаты в индекс отпечатков не
+    # входят: их ищут по оригиналам)
+    def loadfingerprints(self):
+        self.fingerprints.clear()
+        for (urlid, exact, sim) in self.con.execute(
+                "SELECT urlid, exact, simhash FROM fingerprints WHERE canonical IS NULL"):
+            self.fingerprints.add(urlid, fingerprint.unsigned(exact), fingerprint.unsigned(sim))
+
+    # Проверка страницы на дубликат до записи её слов [(позиция, слово)].
+    # Отпечаток каждой страницы сохраняется в fingerprints; у дубликата там
+    # же указан canonical - страница, копией которой он считается. Дубликат
+    # помечается проиндексированным, но строк в wordlocation не получает
+    def isduplicate(self, url, words):
+        if not self.dedup:
+            return False
+        text = [word for (i, word) in words]
+        exact = fingerprint.exacthash(text)
+        sim = fingerprint.simhash(text, ignorewords)
+        urlid = self.frontier.geturlid(self.con, url)
+        (canonical, kind) = self.fingerprints.find(exact, sim, len(text))
+        if canonical == urlid:
+            canonical = None
+        self.con.execute(
+            "INSERT OR REPLACE INTO fingerprints(urlid, exact, simhash, canonical) VALUES (?, ?, ?, ?)",
+            (urlid, fingerprint.signed(exact), fingerprint.signed(sim), canonical)
+        )
+        if canonical is None:
+            self.fingerprints.add(urlid, exact, sim)
+            return False
+
+        print(f'Дубликат {url} ({kind})')
+        rows = sum(1 for word in text if word not in ignorewords)
+        self.frontier.markindexed(url)
+        self.dupstats['pages'] += 1
+        self.dupstats[kind] += 1
+        self.dupstats['rows'] += rows
+        metrics.count('crawl.duplicates')
+        metrics.count('crawl.duplicates.rows', rows)
+        return True
+
+    # Сохранение фронтира после обхода, если задан frontierpath
+    def savefrontier(self):
+        if self.frontierpath is not None:
+            self.frontier.save(self.frontierpath, getgeneration(self.con, 'crawl'))
+
+    # Идентификаторы для списка слов: сначала кэш, затем один SELECT на пачку
+    # неизвестных слов, а новые слова вставляются пачкой с заранее выделенными rowid
+    def getwordids(self, words):
+        missing = [word for word in set(words) if word not in self.wordids]
+        for i in range(0, len(missing), 500):
+            chunk = missing[i:i + 500]
+            marks = ','.join('?' * len(chunk))
+            cur = self.con.execute(f"SELECT rowid, word FROM wordlist WHERE word IN ({marks})", chunk)
+            for (rowid, word) in cur:
+                self.wordids[word] = rowid
+
+        new = [word for word in missing if word not in self.wordids]
+        if new:
+            first = (self.con.execute("SELECT max(rowid) FROM wordlist").fetchone()[0] or 0) + 1
+            rows = [(first + i, word) for (i, word) in enumerate(new)]
+            self.con.executemany("INSERT INTO wordlist(rowid, word) VALUES (?, ?)", rows)
+            for (rowid, word) in rows:
+                self.wordids[word] = rowid
+        return self.wordids
+
+    # Скорость индексирования: слов и страниц в секунду
+    def indexrate(self):
+        stats = self.indexstats
+        seconds = max(stats['seconds'], 1e-9)
+        return {
+            'pages': stats['pages'],
+            'words': stats['words'],
+            'seconds': stats['seconds'],
+            'pagespersec': stats['pages'] / seconds,
+            'wordspersec': stats['words'] / seconds,
+        }
+
+    # Вспомогательная функция для добавления или получения идентификатора
+    def getentryid(self, table, field, value, createnew=True):
+        cur = self.con.execute(f"SELECT rowid FROM {table} WHERE {field}=?", (value,))
+        res = cur.fetchone()
+        if res is None:
+            if createnew:
+                cur = self.con.execute(f"INSERT INTO {table} ({field}) VALUES (?)", (value,))
+                return cur.lastrowid
+            else:
+                return None
+        else:
+            return res[0]
+
+    # Индексирование одной страницы по дереву BeautifulSoup
+    def addtoindex(self, url, soup):
+        if self.isindexed(url):
+            return
+        text = self.gettextonly(soup)
+        words = list(enumerate(self.separatewords(text)))
+        if not self.isduplicate(url, words):
+            self.addwords(url, words)
+
+    # Запись слов страницы [(позиция, слово)] в индекс
+    def addwords(self, url, words):
+        print(f'Индексируется {url}')
+        start = time.perf_counter()
+        urlid = self.frontier.geturlid(self.con, url)
+        self.frontier.markindexed(url)
+        self.invalidatepostings()
+        words = [(i, word) for (i, word) in words if word not in ignorewords]
+
+        if self.bulk:
+            wordids = self.getwordids([word for (i, word) in words])
+            self.locationbuffer.extend((urlid, wordids[word], i) for (i, word) in words)
+            self.pendingurls.add(urlid)
+            self.pendingpages += 1
+        else:
+            for (i, word) in words:
+                wordid = self.getentryid('wordlist', 'word', word)
+                self.con.execute(
+                    "INSERT INTO wordlocation(urlid, wordid, location) VALUES (?, ?, ?)",
+                    (urlid, wordid, i)
+                )
+
+        self.indexstats['pages'] += 1
+        self.indexstats['words'] += len(words)
+        metrics.count('crawl.pages')
+        metrics.count('crawl.words', len(words))
+        self.indexstats['seconds'] += time.perf_counter() - start
+
+    # Извлечение текста из HTML-страницы
+    def gettextonly(self, soup):
+        v = soup.string
+        if v is None:
+            return ''.join(self.gettextonly(t) + '\n' for t in soup.contents)
+        else:
+            return v.strip()
+
+    # Разбиение текста на слова
+    def separatewords(self, text):
+        splitter = re.compile(r'\W+')
+        return [s.lower() for s in splitter.split(text) if s != '']
+
+    # Возвращает True, если данный URL уже проиндексирован
+    def isindexed(self, url):
+        return self.frontier.isindexed(url)
+
+    # Добавление ссылки с одной страницы на другую
+    def addlinkref(self, urlFrom, urlTo, linkText):
+        fromid = self.frontier.geturlid(self.con, urlFrom)
+        toid = self.frontier.geturlid(self.con, urlTo)
+        if fromid == toid:
+            return
+        cur = self.con.execute("INSERT INTO link(fromid, toid) VALUES (?, ?)", (fromid, toid))
+        linkid = cur.lastrowid
+        self.changedurls.update((fromid, toid))
+        words = [word for word in self.separatewords(linkText) if word not in ignorewords]
+        if self.bulk:
+            wordids = self.getwordids(words)
+            self.linkwordsbuffer.extend((wordids[word], linkid) for word in words)
+            return
+        for word in words:
+            wordid = self.getentryid('wordlist', 'word', word)
+            self.con.execute("INSERT INTO linkwords(wordid, linkid) VALUES (?, ?)", (wordid, linkid))
+
+    # Удаление из индекса слов страницы и её исходящих ссылок. Страницы, у
+    # которых изменились ссылки, попадают в журнал linkchanges
+    def removepage(self, urlid):
+        if self.bulk and (self.locationbuffer or self.linkwordsbuffer):
+            self.flushindex()
+        targets = [row[0] for row in self.con.execute("SELECT toid FROM link WHERE fromid=?", (urlid,))]
+        self.con.execute("DELETE FROM linkwords WHERE linkid IN (SELECT rowid FROM link WHERE fromid=?)", (urlid,))
+        self.con.execute("DELETE FROM link WHERE fromid=?", (urlid,))
+        self.con.execute("DELETE FROM wordlocation WHERE urlid=?", (urlid,))
+        self.changedurls.add(urlid)
+        self.changedurls.update(targets)
+        self.invalidatepostings()
+
+    # Загрузка страницы: (содержимое, сведения для recordfetch - ETag,
+    # Last-Modified и хэш содержимого); (None, None), если её не удалось получить
+    def fetchpage(self, page, timeout=None):
+        with metrics.timer('crawl.fetch'):
+            try:
+                # Добавьте headers, если сайт блокирует
+                req = urllib.request.Request(page, headers={'User-Agent': 'Mozilla/5.0'})
+                c = urllib.request.urlopen(req, timeout=timeout)
+                content = c.read()
+                return content, (c.headers.get('ETag'), c.headers.get('Last-Modified'), fingerprint.contenthash(content))
+            except Exception as e:
+                print(f"Не могу открыть {page}: {e}")
+                metrics.count('crawl.fetch.errors')
+                return None, None
+
+    # Сведения о загрузке только что обработанной страницы. По ним первый же
+    # визит Recrawler - условный запрос, и неизменная страница не
+    # переиндексируется. Срок визита назначает Recrawler.schedule
+    def recordfetch(self, url, fetchinfo):
+        (etag, lastmodified, digest) = fetchinfo
+        now = time.time()
+        self.con.execute(
+            "INSERT OR REPLACE INTO fetchmeta(urlid, etag, lastmodified, contenthash, firstfetch, lastfetch, fetches, "
+            "changes) VALUES (?, ?, ?, ?, ?, ?, 1, 0)",
+            (self.frontier.geturlid(self.con, url), etag, lastmodified, digest, now, now)
+        )
+
+    # Индексирование страницы по потоку событий extractor.extract: слова
+    # сразу идут в индекс, ссылки - в link/linkwords. Возвращает новые URL.
+    # Время разбора, если события вычитываются из генератора, входит во время
+    # этапа crawl.index и отдельно учитывается в crawl.parse. С reindex=True
+    # прежние слова и исходящие ссылки страницы удаляются и она индексируется
+    # заново. fetchinfo - сведения о загрузке из fetchpage для recordfetch
+    def indexpage(self, page, events, reindex=False, fetchinfo=None):
+        page = frontier.normalizeurl(page)
+        with metrics.timer('crawl.index'):
+            newpages = set()
+            if reindex:
+                self.removepage(self.frontier.geturlid(self.con, page))
+            indexed = self.isindexed(page) and not reindex
+            words = []
+
+            for event in events:
+                if event[0] == 'word':
+                    if not indexed:
+                        words.append((event[2], event[1]))
+                    continue
+                (kind, href, linkText) = event
+                url = urljoin(page, href)
+                if url.find("'") != -1:
+                    continue
+                url = frontier.normalizeurl(url)
+                if url[0:4] == 'http' and not self.isindexed(url):
+                    newpages.add(url)
+                self.addlinkref(page, url, linkText)
+
+            if not indexed:
+                if fetchinfo is not None:
+                    self.recordfetch(page, fetchinfo)
+                if not self.isduplicate(page, words):
+                    self.addwords(page, words)
+        self.dbcommit()
+        return newpages
+
+    # Поиск в ширину до заданной глубины, индексируя все встречающиеся по пути
+    def crawl(self, pages, depth=2):
+        for i in range(depth):
+            newpages = set()
+            for page in pages:
+                (content, fetchinfo) = self.fetchpage(page)
+                if content is None:
+                    continue
+                newpages |= self.indexpage(page, metrics.timediter('crawl.parse', extractor.extract(content)),
+                                           fetchinfo=fetchinfo)
+            pages = newpages
+        if self.bulk:
+            self.flushindex()
+        self.savefrontier()
+        return self.indexrate()
+
+    # Тот же поиск в ширину, но страницы загружают и разбирают workers потоков.
+    # URL уровня подаются через ограниченную очередь queuesize, к одному хосту
+    # идёт не больше perhost запросов с паузой delay, а в базу пишет только
+    # вызывающий поток, так что соединение SQLite остаётся однопоточным
+    def crawlconcurrent(self, pages, depth=2, workers=8, perhost=2, delay=0.0, queuesize=100, timeout=10):
+        limiter = HostLimiter(perhost, delay)
+
+        def fetcher(tasks, results):
+            while True:
+                page = tasks.get()
+                if page is None:
+                    results.put(None)
+                    return
+                host = urlsplit(page).netloc
+                limiter.acquire(host)
+                try:
+                    (content, fetchinfo) = self.fetchpage(page, timeout)
+                finally:
+                    limiter.release(host)
+                events = None
+                if content is not None:
+                    with metrics.timer('crawl.parse'):
+                        events = list(extractor.extract(content))
+                results.put((page, events, fetchinfo))
+
+        def feeder(tasks, level):
+            for page in level:
+                tasks.put(page)
+            for _ in range(workers):
+                tasks.put(None)
+
+        for i in range(depth):
+            tasks = queue.Queue(maxsize=queuesize)
+            results = queue.Queue(maxsize=queuesize)
+            threads = [threading.Thread(target=feeder, args=(tasks, list(pages)), daemon=True)]
+            threads += [threading.Thread(target=fetcher, args=(tasks, results), daemon=True) for _ in range(workers)]
+            for t in threads:
+                t.start()
+
+            newpages = set()
+            running = workers
+            while running:
+                item = results.get()
+                if item is None:
+                    running -= 1
+                    continue
+                (page, events, fetchinfo) = item
+                if events is not None:
+                    newpages |= self.indexpage(page, events, fetchinfo=fetchinfo)
+
+            for t in threads:
+                t.join()
+            pages = newpages
+        if self.bulk:
+            self.flushindex()
+        self.savefrontier()
+        return self.indexrate()
+
+    # Создание таблиц в базе данных в текущей схеме (см. schema.py)
+    def createindextables(self):
+        schema.createtables(self.con)
+        bumpgeneration(self.con, crawl=True)
+        self.con.commit()
+        self.wordids.clear()
+        self.frontier.clear()
+        self.fingerprints.clear()
+
+    # Построение инвертированного индекса: для каждого слова сжатый список
+    # документов с позициями (см. postings.py). Запускается после обхода
+    def buildpostings(self):
+        writepostings(self.con)
+        self.postingsvalid = True
+
+    # Новые страницы делают индекс устаревшим: он удаляется, и Searcher
+    # читает wordlocation, пока buildpostings не будет запущен снова
+    def invalidatepostings(self):
+        if self.postingsvalid:
+            self.con.execute('drop table if exists postings')
+            self.postingsvalid = False
+
+    # PageRank по графу, загруженному в память одним запросом; итерации
+    # продолжаются, пока изменение рангов не станет меньше tolerance.
+    # С incremental=True ранги дообновляются от прошлого расчёта только вокруг
+    # страниц из журнала linkchanges, пока сдвиг ранга больше threshold; если
+    # так ранги не обновить, выполняется полный расчёт
+    def calculatepagerank(self, iterations=100, tolerance=1e-6, incremental=False, threshold=1e-4):
+        self.flushchanges()
+        if incremental:
+            updater = pagerank.IncrementalPageRank(self.con, threshold=threshold)
+            result = updater.run() if updater.ready() else None
+            if result is not None:
+                updates, delta = result
+                print(f"PageRank: дообновлено {updates} страниц, наибольшее изменение {delta:.2e}")
+                self.buildfeatures()
+                return updates, delta
+
+        graph = pagerank.LinkGraph(self.con)
+        pr, done, residual = pagerank.poweriteration(graph, iterations, tolerance)
+        print(f"PageRank: {done} итераций, невязка {residual:.2e}")
+        pagerank.savepagerank(self.con, graph, pr)
+        self.buildfeatures()
+        return done, residual
+
+    # Предрасчёт признаков документов, которые меняются только после обхода
+    # и PageRank: число входящих и исходящих ссылок, ранг страницы, а также
+    # для каждого слова из текста ссылок сумма рангов ссылающихся страниц.
+    # Признаки - снимок на момент построения: у страниц, проиндексированных
+    # после последнего calculatepagerank, они нулевые или устаревшие (раньше
+    # входящие ссылки считались запросом к link при каждом поиске), пока
+    # calculatepagerank не будет запущен снова
+    def buildfeatures(self):
+        self.con.execute('drop table if exists features')
+        self.con.execute('drop table if exists anchortext')
+        self.con.execute('create table features(urlid integer primary key, inbound integer, pagerank real, outdegree integer)')
+        self.con.execute('create table anchortext(wordid integer, toid integer, score real)')
+        self.con.execute(
+            'INSERT INTO features(urlid, inbound, pagerank, outdegree) '
+            'SELECT u.rowid, '
+            '(SELECT COUNT(*) FROM link WHERE toid=u.rowid), '
+            '(SELECT score FROM pagerank WHERE urlid=u.rowid), '
+            '(SELECT COUNT(*) FROM link WHERE fromid=u.rowid) '
+            'FROM urllist u'
+        )
+        self.con.execute(
+            'INSERT INTO anchortext(wordid, toid, score) '
+            'SELECT linkwords.wordid, link.toid, SUM(pagerank.score) '
+            'FROM linkwords, link, pagerank '
+            'WHERE linkwords.linkid=link.rowid AND pagerank.urlid=link.fromid '
+            'GROUP BY linkwords.wordid, link.toid'
+        )
+        self.con.execute('create index anchortextidx on anchortext(wordid)')
+        bumpgeneration(self.con)
+        self.con.commit()
+
+
+class Searcher:
+    # cache - необязательный QueryCache для результатов запросов; readonly -
+    # открыть базу только для чтения
+    def __init__(self, dbname, cache=None, readonly=False):
+        self.dbname = dbname
+        self.con = connectreadonly(dbname) if readonly else instrument.connect(dbname)
+        schema.setpragmas(self.con, readonly)
+        self.net = mynet
+        self.cache = cache
+        self.generation = getgeneration(self.con)
+        self.loadfeatures()
+
+    def __del__(self):
+        self.con.close()
+
+    # Загрузка признаков, построенных Crawler.buildfeatures, в массивы по urlid.
+    # Если их нет, признаки считаются запросами к базе, как раньше
+    def loadfeatures(self):
+        self.features = None
+        self.anchortext = None
+        tables = set(row[0] for row in self.con.execute("SELECT name FROM sqlite_master WHERE type='table'"))
+        if 'features' not in tables or 'anchortext' not in tables:
+            return
+
+        rows = self.con.execute("SELECT urlid, inbound, pagerank, outdegree FROM features").fetchall()
+        size = max([row[0] for row in rows], default=0) + 1
+        self.features = {
+            'inbound': np.zeros(size, dtype=np.int64),
+            'pagerank': np.zeros(size),
+            'outdegree': np.zeros(size, dtype=np.int64),
+        }
+        for (urlid, inbound, pr, outdegree) in rows:
+            self.features['inbound'][urlid] = inbound
+            self.features['pagerank'][urlid] = pr if pr is not None else 0.0
+            self.features['outdegree'][urlid] = outdegree
+
+        self.anchortext = {}
+        for (wordid, toid, score) in self.con.execute("SELECT wordid, toid, score FROM anchortext"):
+            self.anchortext.setdefault(wordid, {})[toid] = score
+
+    # Значение признака документа (0 для URL, появившихся после построения)
+    def feature(self, name, urlid):
+        values = self.features[name]
+        return values[urlid].item() if urlid < len(values) else 0
+
+    # Есть ли построенный инвертированный индекс
+    def haspostings(self):
+        return self.con.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='postings'").fetchone() is not None
+
+    # Список документов слова: (упорядоченные urlid, списки позиций)
+    def getpostings(self, wordid, usepostings=True):
+        if usepostings:
+            row = self.con.execute("SELECT data FROM postings WHERE wordid=?", (wordid,)).fetchone()
+            return postings.decodepostings(row[0]) if row is not None else ([], [])
+        cur = self.con.execute(
+            "SELECT wordid, urlid, location FROM wordlocation WHERE wordid=? ORDER BY urlid, location", (wordid,)
+        )
+        for (w, docs) in postings.groupwordlocations(cur):
+            return [urlid for (urlid, positions) in docs], [positions for (urlid, positions) in docs]
+        return [], []
+
+    # Списки документов сразу для многих слов, по пачкам в один запрос:
+    # {wordid: (упорядоченные urlid, списки позиций)}
+    def getpostingsmany(self, wordids):
+        wordids = list(wordids)
+        usepostings = self.haspostings()
+        result = {}
+        for i in range(0, len(wordids), 500):
+            chunk = wordids[i:i + 500]
+            marks = ','.join('?' * len(chunk))
+            if usepostings:
+                for (wordid, data) in self.con.execute(
+                        f"SELECT wordid, data FROM postings WHERE wordid IN ({marks})", chunk):
+                    result[wordid] = postings.decodepostings(data)
+                continue
+            cur = self.con.execute(
+                f"SELECT wordid, urlid, location FROM wordlocation WHERE wordid IN ({marks}) "
+                f"ORDER BY wordid, urlid, location", chunk
+            )
+            for (wordid, docs) in postings.groupwordlocations(cur):
+                result[wordid] = ([urlid for (urlid, positions) in docs], [positions for (urlid, positions) in docs])
+        for wordid in wordids:
+            result.setdefault(wordid, ([], []))
+        return result
+
+    # Разбор запроса на слова. Слова в кавычках образуют фразу: они должны
+    # стоять в документе подряд. Возвращает слова и фразы - отрезки
+    # (начало, конец) в списке слов
+    def parsequery(self, query):
+        words = []
+        phrases = []
+        for (phrase, word) in querypattern.findall(query):
+            if word:
+                words.append(word)
+                continue
+            phrasewords = phrase.split()
+            if len(phrasewords) > 1:
+                phrases.append((len(words), len(words) + len(phrasewords)))
+            words.extend(phrasewords)
+        return words, phrases
+
+    # Поиск совпадений для слов запроса: документы, где есть все слова (и все
+    # фразы), и для каждого из них кортеж упорядоченных списков позиций
+    # каждого слова
+    def getmatches(self, query):
+        wordids, phrases = self.getqueryids(query)
+        if not wordids:  # Если нет слов, вернуть пустой результат
+            return {}, []
+        return self.findmatches(wordids, phrases), wordids
+
+    # Идентификаторы слов запроса и фразы - отрезки (начало, конец) в списке
+    # идентификаторов. Фраза с незнакомым словом не встречается ни в одном
+    # документе, тогда возвращается пустой список слов. lookup - готовый
+    # словарь слово -> wordid (см. getwordids) вместо поиска по одному слову
+    def getqueryids(self, query, lookup=None):
+        words, phrases = self.parsequery(query)
+        wordids = []
+        indexes = []
+        for word in words:
+            wordid = self.getwordid(word) if lookup is None else lookup.get(word)
+            if wordid is not None:
+                indexes.append(len(wordids))
+                wordids.append(wordid)
+            else:
+                indexes.append(None)
+
+        if any(indexes[i] is None for (start, end) in phrases for i in range(start, end)):
+            return [], []
+        return wordids, [(indexes[start], indexes[end - 1] + 1) for (start, end) in phrases]
+
+    def getwordid(self, word):
+        wordrow = self.con.execute("SELECT rowid FROM wordlist WHERE word=?", (word,)).fetchone()
+        return wordrow[0] if wordrow is not None else None
+
+    # wordid известных слов из words, по пачкам в один запрос
+    def getwordids(self, words):
+        words = list(words)
+        result = {}
+        for i in range(0, len(words), 500):
+            chunk = words[i:i + 500]
+            marks = ','.join('?' * len(chunk))
+            for (word, wordid) in self.con.execute(
+                    f"SELECT word, min(rowid) FROM wordlist WHERE word IN ({marks}) GROUP BY word", chunk):
+                result[word] = wordid
+        return result
+
+    # Документы, где есть все слова wordids и все фразы. lists - уже
+    # прочитанные списки документов {wordid: (urlids, позиции)}
+    def findmatches(self, wordids, phrases, lists=None):
+        if lists is None:
+            usepostings = self.haspostings()
+            lists = {}
+            for wordid in wordids:
+                if wordid not in lists:
+                    lists[wordid] = self.getpostings(wordid, usepostings)
+        wordlists = [lists[wordid] for wordid in wordids]
+
+        matches = {}
+        for (urlid, pointers) in postings.intersect([urlids for (urlids, positions) in wordlists]):
+            positions = tuple(wordlists[i][1][p] for (i, p) in enumerate(pointers))
+            if all(postings.phrasestarts(positions[start:end]) for (start, end) in phrases):
+                matches[urlid] = positions
+        return matches
+
+    # Признаки ранжирования с их весами. Вместо distancescore можно передать
+    # свой словарь оценок близости (его заполняет gettopk по мере надобности)
+    def getweights(self, matches, wordids, distancescores=None):
+        return [
+            (1.0, self.timedscore('frequency', self.frequencyscore, matches)),
+            (1.0, self.timedscore('location', self.locationscore, matches)),
+            (1.0, self.timedscore('distance', self.distancescore, matches)
+             if distancescores is None else distancescores),
+            (1.0, self.timedscore('inboundlink', self.inboundlinkscore, matches)),
+            (1.0, self.timedscore('pagerank', self.pagerankscore, matches)),
+            (1.0, self.timedscore('linktext', self.linktextscore, matches, wordids)),
+            (1.0, self.timedscore('nn', self.nnscore, matches, wordids))
+        ]
+
+    # Вызов признака с замером в этапе query.score.<name>
+    def timedscore(self, name, scorer, *args):
+        with metrics.timer('query.score.' + name):
+            return scorer(*args)
+
+    # Ранжирование результатов
+    def getscoredlist(self, matches, wordids):
+        totalscores = dict([(urlid, 0) for urlid in matches])
+        if not matches:
+            return totalscores
+        weights = self.getweights(matches, wordids)
+
+        for (weight, scores) in weights:
+            for url in totalscores:
+                totalscores[url] += weight * scores.get(url, 0)
+
+        return totalscores
+
+    # Лучшие k результатов в том же порядке, что и sorted(getscoredlist(...)).
+    # Самый дорогой признак - близость слов, для него нужен обход позиций.
+    # Нормированная оценка близости не больше 1, поэтому документы проверяются
+    # по убыванию верхней границы (остальные признаки + вес близости), лучшие
+    # держатся в куче, а обход останавливается, когда граница очередного
+    # документа ниже k-го результата. Для точной нормировки нужен минимум
+    # расстояния по всем документам: он известен, как только найден документ
+    # с наименьшим возможным расстоянием (по 1 на пару разных соседних слов)
+    def gettopk(self, matches, wordids, k=10):
+        if not matches:
+            return []
+        if len(wordids) <= 1:
+            scores = self.getscoredlist(matches, wordids)
+            return heapq.nlargest(k, [(score, url) for (url, score) in scores.items()])
+
+        distscores = {}
+        weights = self.getweights(matches, wordids, distscores)
+        (distweight, _) = weights[2]
+        others = [(weight, scores) for (weight, scores) in weights if scores is not distscores]
+        bounds = dict([(url, sum(weight * scores.get(url, 0) for (weight, scores) in others) + distweight)
+                       for url in matches])
+        order = sorted(matches, key=lambda url: bounds[url], reverse=True)
+        lowest = sum(1 for i in range(1, len(wordids)) if wordids[i] != wordids[i - 1])
+
+        distances = {}
+        dmin = None
+        with metrics.timer('query.score.distance'):
+            for url in order:
+                if dmin == lowest:
+                    break
+                distances[url] = self.mindistance(matches[url])
+                if dmin is None or distances[url] < dmin:
+                    dmin = distances[url]
+
+        def score(url):
+            distscores[url] = float(dmin) / max(0.00001, distances[url])
+            total = 0
+            for (weight, scores) in weights:
+                total += weight * scores.get(url, 0)
+            return total
+
+        heap = []
+        for url in order:
+            if len(heap) == k and bounds[url] < heap[0][0] - 1e-9:
+                break
+            if url not in distances:
+                with metrics.timer('query.score.distance'):
+                    distances[url] = self.mindistance(matches[url])
+            item = (score(url), url)
+            if len(heap) < k:
+                heapq.heappush(heap, item)
+            elif item > heap[0]:
+                heapq.heapreplace(heap, item)
+        return sorted(heap, reverse=True)
+
+    def getgeneration(self):
+        return getgeneration(self.con)
+
+    def geturlname(self, id):
+        return self.con.execute("SELECT url FROM urllist WHERE rowid=?", (id,)).fetchone()[0]
+
+    # URL многих документов, по пачкам в один запрос: {urlid: url}
+    def geturlnames(self, urlids):
+        urlids = list(urlids)
+        result = {}
+        for i in range(0, len(urlids), 500):
+            chunk = urlids[i:i + 500]
+            marks = ','.join('?' * len(chunk))
+            result.update(self.con.execute(f"SELECT rowid, url FROM urllist WHERE rowid IN ({marks})", chunk))
+        return result
+
+    # Выполнение запроса: k лучших результатов. Если индекс изменился, признаки
+    # перечитываются, а результаты из кэша действительны только для того же
+    # поколения индекса и нейросети
+    def query(self, q, k=10):
+        with metrics.timer('query'):
+            return self.runquery(q, k)
+
+    def runquery(self, q, k):
+        (wordids, results) = self.search(q, k)
+        for (score, urlid, url) in results:
+            print(f"{score:.3f}\t{url}")
+        return wordids, [urlid for (score, urlid, url) in results]
+
+    # k лучших результатов без печати: (wordids, [(оценка, urlid, url)])
+    def search(self, q, k=10):
+        generation = self.getgeneration()
+        if generation != self.generation:
+            self.generation = generation
+            with metrics.timer('query.loadfeatures'):
+                self.loadfeatures()
+
+        key = (' '.join(q.split()), k)
+        generation = (generation, self.net.generation)
+        cached = self.cache.get(key, generation) if self.cache is not None else None
+        metrics.count('query.cache.hits' if cached is not None else 'query.cache.misses')
+        if cached is None:
+            with metrics.timer('query.getmatches'):
+                matches, wordids = self.getmatches(q)
+            with metrics.timer('query.gettopk'):
+                rankedscores = self.gettopk(matches, wordids, k)
+            with metrics.timer('query.geturlname'):
+                cached = (wordids, [(score, urlid, self.geturlname(urlid)) for (score, urlid) in rankedscores])
+            if self.cache is not None:
+                self.cache.put(key, generation, cached)
+        return cached
+
+    # Копия для рабочего потока querymany: признаки общие с исходным
+    # поисковиком, а соединение только для чтения и экземпляр нейросети свои
+    def forkworker(self):
+        worker = copy.copy(self)
+        worker.con = connectreadonly(self.dbname)
+        worker.net = self.net.fork()
+        worker.cache = None
+        return worker
+
+    # Пачка запросов: слова всех запросов ищутся в словаре одним запросом,
+    # списки документов всех слов читаются вместе, URL результатов - тоже.
+    # Для каждого запроса возвращается (wordids, [(оценка, urlid, url)])
+    def runbatch(self, queries, k=10):
+        with metrics.timer('query.getmatches'):
+            lookup = self.getwordids(set(word for q in queries for word in self.parsequery(q)[0]))
+            queryids = [self.getqueryids(q, lookup) for q in queries]
+            lists = self.getpostingsmany(set(wordid for (wordids, phrases) in queryids for wordid in wordids))
+
+        ranked = []
+        for (wordids, phrases) in queryids:
+            with metrics.timer('query'):
+                with metrics.timer('query.getmatches'):
+                    matches = self.findmatches(wordids, phrases, lists) if wordids else {}
+                with metrics.timer('query.gettopk'):
+                    ranked.append((wordids, self.gettopk(matches, wordids, k)))
+
+        with metrics.timer('query.geturlname'):
+            names = self.geturlnames(set(urlid for (wordids, results) in ranked for (score, urlid) in results))
+        return [(wordids, [(score, urlid, names[urlid]) for (score, urlid) in results])
+                for (wordids, results) in ranked]
+
+    # Выполнение многих запросов сразу, например для оценочных прогонов по
+    # журналу запросов. Запросы делятся на пачки по batchsize (см. runbatch),
+    # пачки считают workers потоков, у каждого своя копия поисковика
+    # (forkworker). Результаты в порядке запросов, без печати и кэша
+    def querymany(self, queries, k=10, workers=4, batchsize=500):
+        queries = list(queries)
+        generation = self.getgeneration()
+        if generation != self.generation:
+            self.generation = generation
+            self.loadfeatures()
+        batches = [queries[i:i + batchsize] for i in range(0, len(queries), batchsize)]
+        if workers <= 1:
+            return [result for batch in batches for result in self.runbatch(batch, k)]
+
+        local = threading.local()
+
+        def run(batch):
+            worker = getattr(local, 'worker', None)
+            if worker is None:
+                worker = local.worker = self.forkworker()
+            return worker.runbatch(batch, k)
+
+        with ThreadPoolExecutor(workers) as pool:
+            return [result for part in pool.map(run, batches) for result in part]
+
+    def normalizescores(self, scores, smallIsBetter=0):
+        vsmall = 0.00001  # Предотвратить деление на нуль
+        if smallIsBetter:
+            minscore = min(scores.values()) if scores else vsmall
+            return dict([(u, float(minscore) / max(vsmall, scores[u])) for u in scores])
+        else:
+            maxscore = max(scores.values())
+            if maxscore == 0: maxscore = vsmall
+            return dict([(u, float(c) / maxscore) for (u, c) in scores.items()])
+
+    # Число сочетаний позиций слов в документе (столько строк давало соединение)
+    def frequencyscore(self, matches):
+        counts = {}
+        for (urlid, positions) in matches.items():
+            count = 1
+            for plist in positions:
+                count *= len(plist)
+            counts[urlid] = count
+        return self.normalizescores(counts)
+
+    # Наименьшая сумма позиций - это сумма первых позиций каждого слова
+    def locationscore(self, matches):
+        locations = dict([(urlid, sum(plist[0] for plist in positions)) for (urlid, positions) in matches.items()])
+        return self.normalizescores(locations, smallIsBetter=1)
+
+    def distancescore(self, matches):
+        # Если есть только одно слово, любой документ выигрывает!
+        if len(next(iter(matches.values()))) <= 1:
+            return dict([(urlid, 1.0) for urlid in matches])
+
+        mindistance = dict([(urlid, self.mindistance(positions)) for (urlid, positions) in matches.items()])
+        return self.normalizescores(mindistance, smallIsBetter=1)
+
+    # Наименьшая по всем сочетаниям позиций сумма расстояний между соседними
+    # словами запроса: динамическое программирование по словам. Списки позиций
+    # упорядочены, поэтому лучшее продолжение для каждой позиции ищется двумя
+    # проходами навстречу друг другу с накоплением минимума - за время,
+    # линейное по числу позиций, а не по числу их сочетаний
+    def mindistance(self, positions):
+        prev = positions[0]
+        best = [0] * len(prev)
+        for plist in positions[1:]:
+            # Предыдущее слово левее: dist + pos - prevpos
+            current = []
+            low = None
+            j = 0
+            for pos in plist:
+                while j < len(prev) and prev[j] <= pos:
+                    if low is None or best[j] - prev[j] < low:
+                        low = best[j] - prev[j]
+                    j += 1
+                current.append(low + pos if low is not None else None)
+
+            # Предыдущее слово правее: dist + prevpos - pos
+            low = None
+            j = len(prev) - 1
+            for i in range(len(plist) - 1, -1, -1):
+                pos = plist[i]
+                while j >= 0 and prev[j] >= pos:
+                    if low is None or best[j] + prev[j] < low:
+                        low = best[j] + prev[j]
+                    j -= 1
+                if low is not None and (current[i] is None or low - pos < current[i]):
+                    current[i] = low - pos
+
+            prev = plist
+            best = current
+        return min(best)
+
+    def inboundlinkscore(self, matches):
+        uniqueurls = set(matches)
+        if self.features is not None:
+            inboundcount = dict([(u, self.feature('inbound', u)) for u in uniqueurls])
+        else:
+            inboundcount = dict([(u, self.con.execute(
+                'SELECT COUNT(*) FROM link WHERE toid=?', (u,)
+            ).fetchone()[0]) for u in uniqueurls])
+        return self.normalizescores(inboundcount)
+
+    def pagerankscore(self, matches):
+        if self.features is not None:
+            pageranks = dict([(urlid, self.feature('pagerank', urlid)) for urlid in matches])
+        else:
+            pageranks = dict([(urlid, self.con.execute(
+                'SELECT score FROM pagerank WHERE urlid=?', (urlid,)
+            ).fetchone()[0]) for urlid in matches])
+        maxrank = max(pageranks.values())
+        normalizedscores = dict([(u, float(l) / maxrank) for (u, l) in pageranks.items()])
+        return normalizedscores
+
+    def linktextscore(self, matches, wordids):
+        linkscores = dict([(urlid, 0) for urlid in matches])
+        for wordid in wordids:
+            if self.anchortext is not None:
+                for (toid, pr) in self.anchortext.get(wordid, {}).items():
+                    if toid in linkscores:
+                        linkscores[toid] += pr
+                continue
+            cur = self.con.execute(
+                'SELECT link.fromid, link.toid FROM linkwords, link '
+                'WHERE wordid=? AND linkwords.linkid=link.rowid', (wordid,)
+            )
+            for (fromid, toid) in cur:
+                if toid in linkscores:
+                    pr = self.con.execute(
+                        'SELECT score FROM pagerank WHERE urlid=?', (fromid,)
+                    ).fetchone()[0]
+                    linkscores[toid] += pr
+        maxscore = max(linkscores.values())
+        if maxscore == 0: maxscore = 0.00001  # Ни одна ссылка не содержит слов запроса
+        normalizedscores = dict([(u, float(l) / maxscore) for (u, l) in linkscores.items()])
+        return normalizedscores
+
+    def nnscore(self, matches, wordids):
+        # Получить уникальные идентификаторы URL в виде упорядоченного списка
+        urlids = [urlid for urlid in matches]
+        nnres = self.net.getResult(wordids, urlids)
+        scores = dict([(urlids[i], nnres[i]) for i in range(len(urlids))])
+        return self.normalizescores(scores)
+
+
+# Пример запуска
+if __name__ == "__main__":
+    crawler = Crawler("search.db")
+    # crawler.createindextables()  # Раскомментируйте для создания таблиц
+    # crawler.crawl(["https://www.woman.ru/forum/"], depth=2)  # Раскомментируйте для краулинга
+    # crawler.calculatepagerank()  # Раскомментируйте для расчёта PageRank
+    clicks = nn.ClickQueue('clicks.db')
+    trainer = nn.ClickTrainer(nn.searchnet('nn.db'), clicks)
+    trainer.start()
+
+    searcher = Searcher("search.db")
+    q = searcher.query("мужчина")
+
+    if q is not None:
+        (wordIDs, urlIDs) = q
+        if urlIDs:
+            clicks.append(wordIDs, urlIDs, urlIDs[0])
+    trainer.stop()
@@ -0,0 +1,341 @@
+import json
+import time
+import asyncio
+import threading
+from collections import deque
+from http import HTTPStatus
+from urllib.parse import urlsplit, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import nn
+import searchengine
+from instrument import metrics
+
+
+# Длительный поисковый сервер на asyncio. Searcher, его признаки, соединения
+# и нейросеть загружаются один раз при старте. Запросы считают workers
+# потоков, у каждого своя копия поисковика (Searcher.forkworker) с общим
+# кэшем запросов. Эндпоинты:
+#   GET /search?q=...&k=10 (или POST с JSON {"q": ..., "k": ...}) - результаты
+#       потоком NDJSON по мере готовности: строка запроса, строка с числом
+#       найденных документов, по строке на результат и итоговая строка с
+#       временем ответа;
+#   POST /click с JSON {"wordids": [...], "urlids": [...], "selected": urlid} -
+#       клик в ClickQueue, на нём обучается фоновый ClickTrainer;
+#   GET /stats - число запросов, отказов, задержки (p50/p95/p99) и QPS;
+#   GET /metrics - замеры instrument в формате Prometheus.
+# Ограничения: строка запроса и заголовки не длиннее maxheader, тело не
+# больше maxbody, запрос не длиннее maxquery символов, k не больше maxk.
+# Если поиска ждут уже maxpending запросов, новый сразу получает 503 -
+# очередь не растёт без предела. Медленный клиент задерживает только свою
+# выдачу: запись ждёт, пока освободится буфер сокета
+class SearchServer:
+    def __init__(self, dbname, host='127.0.0.1', port=8080, workers=4, maxpending=64, timeout=10.0,
+                 maxheader=8192, maxbody=65536, maxquery=1000, maxk=100, cache=None, clickspath='clicks.db',
+                 train=True, window=10000, log=False):
+        self.host = host
+        self.port = port
+        self.maxpending = maxpending
+        self.timeout = timeout
+        self.maxheader = maxheader
+        self.maxbody = maxbody
+        self.maxquery = maxquery
+        self.maxk = maxk
+        self.log = log
+        self.searcher = searchengine.Searcher(dbname, cache)
+        self.cache = cache
+        self.executor = ThreadPoolExecutor(workers)
+        self.local = threading.local()
+        self.clicks = nn.ClickQueue(clickspath)
+        self.trainer = nn.ClickTrainer(self.searcher.net.fork(), self.clicks) if train else None
+        self.server = None
+        self.routes = {
+            ('GET', '/search'): self.handlesearch,
+            ('POST', '/search'): self.handlesearch,
+            ('POST', '/click'): self.handleclick,
+            ('GET', '/stats'): self.handlestats,
+            ('GET', '/metrics'): self.handlemetrics
+        }
+
+        self.started = time.monotonic()
+        self.pending = 0
+        self.requests = {}
+        self.statuses = {}
+        self.rejected = 0
+        self.latencies = {}
+        self.window = window
+
+    # Копия поисковика текущего рабочего потока
+    def worker(self):
+        worker = getattr(self.local, 'worker', None)
+        if worker is None:
+            worker = self.local.worker = self.searcher.forkworker()
+            worker.cache = self.cache
+        return worker
+
+    def search(self, q, k):
+        with metrics.timer('query'):
+            return self.worker().search(q, k)
+
+    # Имя эндпоинта для статистики: путь без '/' или 'unknown'
+    def endpoint(self, path):
+        return path.strip('/') if path in [p for (m, p) in self.routes] else 'unknown'
+
+    def record(self, endpoint, status, seconds):
+        self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+        self.latencies.setdefault(endpoint, deque(maxlen=self.window)).append(seconds)
+        metrics.record('server.' + endpoint, seconds)
+        if self.log:
+            print(f'{endpoint} {status} {1000 * seconds:.1f} мс')
+
+    # Задержки последних window запросов каждого эндпоинта и QPS с момента
+    # запуска
+    def stats(self):
+        uptime = time.monotonic() - self.started
+        latencies = {}
+        for (endpoint, values) in self.latencies.items():
+            ms = 1000.0 * np.array(values)
+            latencies[endpoint] = dict([(name, round(float(np.percentile(ms, q)), 3))
+                                        for (name, q) in [('p50', 50), ('p95', 95), ('p99', 99)]])
+            latencies[endpoint]['mean'] = round(float(ms.mean()), 3)
+        return {
+            'uptime': round(uptime, 3),
+            'requests': self.requests,
+            'statuses': dict([(str(status), n) for (status, n) in self.statuses.items()]),
+            'qps': round(sum(self.requests.values()) / uptime, 3) if uptime > 0 else None,
+            'pending': self.pending,
+            'rejected': self.rejected,
+            'latency_ms': latencies,
+            'cache': self.cache.stats() if self.cache is not None else None
+        }
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port, limit=self.maxheader)
+        if self.trainer is not None:
+            self.trainer.start()
+        (host, port) = self.server.sockets[0].getsockname()[:2]
+        print(f'Сервер слушает http://{host}:{port}')
+
+    async def serve(self):
+        await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+        if self.trainer is not None and self.trainer.is_alive():
+            self.trainer.stop()
+        self.executor.shutdown()
+
+    # Одно соединение: запросы HTTP/1.1 по очереди, пока клиент держит
+    # соединение открытым
+    async def handle(self, reader, writer):
+        writer.transport.set_write_buffer_limits(high=65536)
+        try:
+            while await self.handlerequest(reader, writer):
+                pass
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    # Ответ с ошибкой до вызова обработчика. Такие запросы тоже попадают в
+    # статистику; соединение после них закрывается
+    async def reject(self, writer, status, error, endpoint, start):
+        await self.respond(writer, status, {'error': error})
+        self.record(endpoint, int(status), time.perf_counter() - start)
+        return False
+
+    # Разбор и обработка одного запроса. Возвращает True, если соединение
+    # можно использовать дальше
+    async def handlerequest(self, reader, writer):
+        start = None
+        try:
+            line = await asyncio.wait_for(reader.readline(), self.timeout)
+            if not line:
+                return False
+            start = time.perf_counter()
+            parts = line.decode('latin-1').split()
+            headers = {}
+            size = len(line)
+            while True:
+                header = await asyncio.wait_for(reader.readline(), self.timeout)
+                size += len(header)
+                if size > self.maxheader:
+                    raise ValueError
+                if header in (b'\r\n', b'\n', b''):
+                    break
+                (name, _, value) = header.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+        except ValueError:
+            return await self.reject(writer, HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE, 'заголовки слишком длинные',
+                                     'unknown', start or time.perf_counter())
+        if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+            return await self.reject(writer, HTTPStatus.BAD_REQUEST, 'неверная строка запроса', 'unknown', start)
+
+        (method, target, version) = parts
+        url = urlsplit(target)
+        endpoint = self.endpoint(url.path)
+        # Клиенту HTTP/1.0 выдача идёт без chunked, до закрытия соединения
+        chunked = version == 'HTTP/1.1'
+        keepalive = chunked and headers.get('connection', '').lower() != 'close'
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            return await self.reject(writer, HTTPStatus.BAD_REQUEST, 'неверный Content-Length', endpoint, start)
+        if length > self.maxbody:
+            return await self.reject(writer, HTTPStatus.REQUEST_ENTITY_TOO_LARGE, 'тело запроса слишком большое',
+                                     endpoint, start)
+        body = await asyncio.wait_for(reader.readexactly(length), self.timeout) if length else b''
+
+        params = dict([(name, values[-1]) for (name, values) in parse_qs(url.query).items()])
+        handler = self.routes.get((method, url.path))
+        if handler is None:
+            status = HTTPStatus.NOT_FOUND if endpoint == 'unknown' else HTTPStatus.METHOD_NOT_ALLOWED
+            await self.respond(writer, status, {'error': f'{method} {url.path} не поддерживается'})
+        else:
+            try:
+                status = await handler(writer, params, body, chunked)
+            except ValueError as e:
+                status = HTTPStatus.BAD_REQUEST
+                await self.respond(writer, status, {'error': str(e)})
+        self.record(endpoint, int(status), time.perf_counter() - start)
+        return keepalive
+
+    async def respond(self, writer, status, body, contenttype='application/json; charset=utf-8', headers=()):
+        data = body if isinstance(body, bytes) else json.dumps(body, ensure_ascii=False).encode('utf-8')
+        head = [f'HTTP/1.1 {status.value} {status.phrase}', f'Content-Type: {contenttype}',
+                f'Content-Length: {len(data)}']
+        head.extend(f'{name}: {value}' for (name, value) in headers)
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode('latin-1') + data)
+        await writer.drain()
+
+    # Строка NDJSON потоковой выдачи, с chunked - отдельным куском
+    async def sendline(self, writer, value, chunked):
+        data = json.dumps(value, ensure_ascii=False).encode('utf-8') + b'\n'
+        writer.write(b'%x\r\n%s\r\n' % (len(data), data) if chunked else data)
+        await writer.drain()
+
+    # Последняя строка выдачи и конец потока
+    async def endstream(self, writer, value, chunked):
+        await self.sendline(writer, value, chunked)
+        if chunked:
+            writer.write(b'0\r\n\r\n')
+            await writer.drain()
+
+    # Поиск завершился в рабочем потоке, в том числе после истечения времени
+    def searchdone(self, future):
+        self.pending -= 1
+        if not future.cancelled():
+            future.exception()
+
+    # Параметры из строки запроса или из JSON тела
+    def getparams(self, params, body):
+        if not body:
+            return params
+        try:
+            value = json.loads(body)
+        except ValueError:
+            raise ValueError('тело запроса - не JSON')
+        if not isinstance(value, dict):
+            raise ValueError('тело запроса должно быть объектом JSON')
+        return value
+
+    async def handlesearch(self, writer, params, body, chunked):
+        params = self.getparams(params, body)
+        q = params.get('q')
+        if not isinstance(q, str) or not q.strip():
+            raise ValueError('нужен параметр q')
+        if len(q) > self.maxquery:
+            raise ValueError(f'запрос длиннее {self.maxquery} символов')
+        try:
+            k = int(params.get('k', 10))
+        except (TypeError, ValueError):
+            raise ValueError('k должно быть числом')
+        if not 1 <= k <= self.maxk:
+            raise ValueError(f'k должно быть от 1 до {self.maxk}')
+        if self.pending >= self.maxpending:
+            self.rejected += 1
+            await self.respond(writer, HTTPStatus.SERVICE_UNAVAILABLE, {'error': 'сервер перегружен'},
+                               headers=[('Retry-After', '1')])
+            return HTTPStatus.SERVICE_UNAVAILABLE
+
+        # Поиск занимает место в очереди, пока не закончится в рабочем потоке,
+        # даже если клиент уже получил ответ об истечении времени
+        start = time.perf_counter()
+        self.pending += 1
+        future = asyncio.get_running_loop().run_in_executor(self.executor, self.search, q, k)
+        future.add_done_callback(self.searchdone)
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: application/x-ndjson; charset=utf-8\r\n' +
+                     (b'Transfer-Encoding: chunked\r\n' if chunked else b'') + b'\r\n')
+        await self.sendline(writer, {'query': q, 'k': k}, chunked)
+        try:
+            (wordids, results) = await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            await self.endstream(writer, {'error': 'время поиска истекло'}, chunked)
+            return HTTPStatus.GATEWAY_TIMEOUT
+        except Exception as e:
+            await self.endstream(writer, {'error': f'ошибка поиска: {e}'}, chunked)
+            return HTTPStatus.INTERNAL_SERVER_ERROR
+
+        await self.sendline(writer, {'wordids': wordids, 'count': len(results)}, chunked)
+        for (rank, (score, urlid, url)) in enumerate(results):
+            await self.sendline(writer, {'rank': rank + 1, 'score': score, 'urlid': urlid, 'url': url}, chunked)
+        await self.endstream(writer, {'done': True, 'ms': round(1000 * (time.perf_counter() - start), 3)}, chunked)
+        return HTTPStatus.OK
+
+    async def handleclick(self, writer, params, body, chunked):
+        params = self.getparams(params, body)
+        (wordids, urlids, selected) = (params.get('wordids'), params.get('urlids'), params.get('selected'))
+        if not isinstance(wordids, list) or not isinstance(urlids, list) or \
+                not all(isinstance(v, int) for v in wordids + urlids + [selected]):
+            raise ValueError('нужны целые wordids, urlids и selected')
+        if not wordids or not urlids or len(wordids) > self.maxk or len(urlids) > self.maxk:
+            raise ValueError(f'в wordids и urlids должно быть от 1 до {self.maxk} элементов')
+        if selected not in urlids:
+            raise ValueError('selected должен быть среди urlids')
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.clicks.append, wordids, urlids,
+                                                         selected)
+        await self.respond(writer, HTTPStatus.ACCEPTED, {'queued': True})
+        return HTTPStatus.ACCEPTED
+
+    async def handlestats(self, writer, params, body, chunked):
+        await self.respond(writer, HTTPStatus.OK, self.stats())
+        return HTTPStatus.OK
+
+    async def handlemetrics(self, writer, params, body, chunked):
+        await self.respond(writer, HTTPStatus.OK, metrics.prometheus().encode('utf-8'),
+                           'text/plain; version=0.0.4; charset=utf-8')
+        return HTTPStatus.OK
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Поисковый HTTP-сервер')
+    parser.add_argument('db', nargs='?', default='search.db', help='база индекса')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=4, help='потоков поиска')
+    parser.add_argument('--max-pending', type=int, default=64, help='запросов в ожидании поиска, сверх - 503')
+    parser.add_argument('--timeout', type=float, default=10.0, help='секунд на чтение запроса и на поиск')
+    parser.add_argument('--cache', type=int, default=1000, help='записей в кэше запросов, 0 - без кэша')
+    parser.add_argument('--clicks', default='clicks.db', help='очередь кликов')
+    parser.add_argument('--no-train', action='store_true', help='не обучать сеть на кликах в этом процессе')
+    parser.add_argument('--metrics', action='store_true', help='включить замеры instrument')
+    parser.add_argument('--log', action='store_true', help='печатать каждый запрос')
+    args = parser.parse_args()
+    if args.metrics:
+        metrics.enable()
+    server = SearchServer(args.db, args.host, args.port, args.workers, args.max_pending, args.timeout,
+                          cache=searchengine.QueryCache(args.cache) if args.cache else None,
+                          clickspath=args.clicks, train=not args.no_train, log=args.log)
+    try:
+        asyncio.run(server.serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
@@ -0,0 +1,232 @@
+import os
+import sqlite3
+import multiprocessing
+import schema
+import searchengine
+
+
+# Файл шарда i: search.db -> search.0.db, search.1.db, ...
+def shardpath(dbname, i):
+    (root, ext) = os.path.splitext(dbname)
+    return f'{root}.{i}{ext}'
+
+
+# Процесс записи одного шарда. Команды приходят через inbox:
+# ('rows', [(urlid, wordid, location)]) - дописать строки индекса,
+# ('remove', [urlid]) - удалить строки страниц перед переиндексацией,
+# ('reset', None) - очистить шард, ('postings', None) - построить postings,
+# ('sync', None) - только подтвердить, что всё предыдущее записано.
+# На все команды, кроме rows и remove, в done отправляется номер шарда
+def shardwriter(path, index, inbox, done):
+    con = sqlite3.connect(path)
+    if 'wordlocation' not in schema.tablenames(con):
+        con.execute(schema.wordlocation.format(name='wordlocation'))
+    con.execute('create index if not exists wordlocationurlidx on wordlocation(urlid)')
+    con.commit()
+    while True:
+        message = inbox.get()
+        if message is None:
+            break
+        (command, rows) = message
+        if command == 'rows':
+            con.execute('drop table if exists postings')
+            con.executemany("INSERT INTO wordlocation(urlid, wordid, location) VALUES (?, ?, ?)", rows)
+            con.commit()
+            continue
+        if command == 'remove':
+            con.execute('drop table if exists postings')
+            con.executemany("DELETE FROM wordlocation WHERE urlid=?", [(urlid,) for urlid in rows])
+            con.commit()
+            continue
+        if command == 'reset':
+            con.execute('drop table if exists postings')
+            con.execute('drop table if exists wordlocation')
+            con.execute(schema.wordlocation.format(name='wordlocation'))
+            con.execute('create index wordlocationurlidx on wordlocation(urlid)')
+            con.commit()
+        elif command == 'postings':
+            searchengine.writepostings(con)
+        done.put(index)
+    con.close()
+
+
+# Паук для шардированного индекса. Общая база dbname хранит всё, что нужно
+# для согласованных глобальных признаков: urllist, wordlist (единый словарь
+# wordid), link, linkwords, pagerank и признаки, а также shardpages - в каком
+# шарде лежит страница. Строки wordlocation распределяются по urlid % shards
+# между файлами шардов, и каждый шард пишет свой процесс. Словарь и urlid
+# выдаёт только этот процесс, поэтому они одинаковы для всех шардов
+class ShardedCrawler(searchengine.Crawler):
+    # Остальные параметры (frontierpath и т.д.) передаются Crawler
+    def __init__(self, dbname, shards=4, flushpages=100, **kwargs):
+        super().__init__(dbname, bulk=True, flushpages=flushpages, **kwargs)
+        self.shards = shards
+        self.done = multiprocessing.Queue()
+        self.inboxes = []
+        self.writers = []
+        for i in range(shards):
+            inbox = multiprocessing.Queue()
+            writer = multiprocessing.Process(target=shardwriter, args=(shardpath(dbname, i), i, inbox, self.done),
+                                             daemon=True)
+            writer.start()
+            self.inboxes.append(inbox)
+            self.writers.append(writer)
+
+    def __del__(self):
+        self.close()
+        super().__del__()
+
+    # Команда всем шардам с ожиданием подтверждения от каждого
+    def sync(self, command='sync'):
+        for inbox in self.inboxes:
+            inbox.put((command, None))
+        for _ in self.inboxes:
+            self.done.get()
+
+    def close(self):
+        if not self.writers:
+            return
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for writer in self.writers:
+            writer.join()
+        self.writers = []
+
+    # Строки индекса уходят процессам шардов, в общую базу пишутся только
+    # shardpages, ссылки и журнал изменений
+    def flushindex(self):
+        parts = [[] for _ in range(self.shards)]
+        for row in self.locationbuffer:
+            parts[row[0] % self.shards].append(row)
+        for (inbox, rows) in zip(self.inboxes, parts):
+            if rows:
+                inbox.put(('rows', rows))
+        self.con.executemany("INSERT OR IGNORE INTO shardpages(urlid, shard) VALUES (?, ?)",
+                             [(urlid, urlid % self.shards) for urlid in self.pendingurls])
+        self.locationbuffer = []
+        super().flushindex()
+
+    # Проиндексированные страницы записаны в shardpages, а не в wordlocation
+    # общей базы
+    indexedpages = ("rowid IN (SELECT urlid FROM shardpages) "
+                    "OR rowid IN (SELECT urlid FROM fingerprints WHERE canonical IS NOT NULL)")
+
+    # Вызывается из Crawler.__init__, поэтому создаёт таблицу
+    def getindexedurls(self):
+        self.con.execute('create table if not exists shardpages(urlid integer primary key, shard integer)')
+        return super().getindexedurls()
+
+    # Строки страницы удаляет процесс её шарда. Команда идёт через ту же
+    # очередь, что и строки, поэтому выполняется до записи новых слов
+    def removepage(self, urlid):
+        super().removepage(urlid)
+        self.inboxes[urlid % self.shards].put(('remove', [urlid]))
+
+    # Обход завершается, когда все шарды записали свои строки
+    def crawl(self, pages, depth=2):
+        rate = super().crawl(pages, depth)
+        self.sync()
+        return rate
+
+    def crawlconcurrent(self, pages, depth=2, **kwargs):
+        rate = super().crawlconcurrent(pages, depth, **kwargs)
+        self.sync()
+        return rate
+
+    def createindextables(self):
+        super().createindextables()
+        self.con.execute('drop table if exists shardpages')
+        self.con.execute('create table shardpages(urlid integer primary key, shard integer)')
+        self.con.commit()
+        self.sync('reset')
+
+    # Каждый шард строит свои postings параллельно с остальными
+    def buildpostings(self):
+        self.sync('postings')
+        self.postingsvalid = True
+
+
+# Чтение одного шарда внутри процесса пула: поиск совпадений тот же, что у
+# Searcher, но без общих признаков
+class ShardReader(searchengine.Searcher):
+    def __init__(self, path):
+        self.con = sqlite3.connect(path)
+
+
+readers = {}
+
+
+# Задача пула: совпадения в одном шарде. Для каждого документа возвращаются
+# сырые значения признаков, зависящих только от позиций слов, - число
+# сочетаний позиций, сумма первых позиций и наименьшее расстояние (None для
+# запроса из одного слова). Нормировка делается по всем шардам сразу
+def searchshard(path, wordids, phrases):
+    reader = readers.get(path)
+    if reader is None:
+        reader = readers[path] = ShardReader(path)
+    result = {}
+    for (urlid, positions) in reader.findmatches(wordids, phrases).items():
+        count = 1
+        for plist in positions:
+            count *= len(plist)
+        location = sum(plist[0] for plist in positions)
+        distance = reader.mindistance(positions) if len(positions) > 1 else None
+        result[urlid] = (count, location, distance)
+    return result
+
+
+# Поиск по шардированному индексу. Запрос раздаётся всем шардам через пул
+# процессов, совпадения сливаются, а ранжирование идёт как у Searcher: общие
+# признаки (ссылки, PageRank, текст ссылок, нейросеть) берутся из общей базы,
+# а позиционные признаки нормируются по совпадениям всех шардов, поэтому
+# оценки те же, что у нешардированного индекса
+class ShardedSearcher(searchengine.Searcher):
+    def __init__(self, dbname, shards=4, processes=None, cache=None):
+        super().__init__(dbname, cache)
+        self.paths = [shardpath(dbname, i) for i in range(shards)]
+        self.pool = multiprocessing.Pool(processes or shards)
+        self.ownspool = True
+
+    def __del__(self):
+        self.close()
+        super().__del__()
+
+    def close(self):
+        if self.pool is not None and self.ownspool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    # Совпадения: {urlid: (число сочетаний, сумма первых позиций, расстояние)}
+    def findmatches(self, wordids, phrases, lists=None):
+        matches = {}
+        for part in self.pool.starmap(searchshard, [(path, wordids, phrases) for path in self.paths]):
+            matches.update(part)
+        return matches
+
+    # Списки документов читают шарды
+    def getpostingsmany(self, wordids):
+        return {}
+
+    # Рабочие потоки querymany отправляют задачи в тот же пул процессов
+    def forkworker(self):
+        worker = super().forkworker()
+        worker.ownspool = False
+        return worker
+
+    def frequencyscore(self, matches):
+        return self.normalizescores(dict([(urlid, match[0]) for (urlid, match) in matches.items()]))
+
+    def locationscore(self, matches):
+        return self.normalizescores(dict([(urlid, match[1]) for (urlid, match) in matches.items()]),
+                                    smallIsBetter=1)
+
+    def distancescore(self, matches):
+        if next(iter(matches.values()))[2] is None:
+            return dict([(urlid, 1.0) for urlid in matches])
+        return self.normalizescores(dict([(urlid, match[2]) for (urlid, match) in matches.items()]),
+                                    smallIsBetter=1)
+
+    # Расстояние уже посчитано шардом
+    def mindistance(self, match):
+        return match[2]
@@ -0,0 +1,247 @@
+import os
+import copy
+import mmap
+import struct
+import sqlite3
+import numpy as np
+import postings
+import searchengine
+
+magic = b'SRCHSNP1'
+
+# Разделы файла снимка в порядке записи: (имя, тип элементов). Тип None -
+# сырые байты. Все разделы выровнены на 8 байт
+sections = [
+    ('termoffsets', np.uint64),   # начала слов в terms, nterms + 1
+    ('terms', None),              # слова в UTF-8, упорядоченные по байтам
+    ('termwordids', np.int64),    # wordid каждого слова
+    ('postwordids', np.int64),    # wordid, у которых есть документы, по возрастанию
+    ('postoffsets', np.uint64),   # начала списков в postdata
+    ('postdata', None),           # списки документов в формате postings.encodepostings
+    ('inbound', np.int64),        # признаки документов, индекс - urlid
+    ('pagerank', np.float64),
+    ('outdegree', np.int64),
+    ('urloffsets', np.uint64),    # начала URL в urls, индекс - urlid
+    ('urls', None),
+    ('anchorwordids', np.int64),  # текст ссылок, упорядочен по wordid
+    ('anchortoids', np.int64),
+    ('anchorscores', np.float64)
+]
+
+# Заголовок: метка, поколение индекса и (смещение, длина) каждого раздела
+header = struct.Struct('<8sQ' + 'QQ' * len(sections))
+
+
+def offsets(chunks):
+    result = [0]
+    for chunk in chunks:
+        result.append(result[-1] + len(chunk))
+    return np.array(result, dtype=np.uint64)
+
+
+# Сборка снимка индекса из базы dbname в файл path. Всё читается в одной
+# транзакции, поэтому снимок согласован, даже если паук продолжает писать.
+# Признаки считаются так же, как в Crawler.buildfeatures. Файл пишется рядом
+# и подменяется целиком, так что читатели видят либо старый, либо новый снимок
+def compilesnapshot(dbname, path):
+    con = sqlite3.connect(dbname)
+    con.execute('BEGIN')
+    try:
+        generation = searchengine.getgeneration(con)
+
+        words = sorted((word.encode('utf-8'), wordid) for (word, wordid) in con.execute(
+            "SELECT word, min(rowid) FROM wordlist GROUP BY word"))
+        postwordids = []
+        postchunks = []
+        cur = con.execute("SELECT wordid, urlid, location FROM wordlocation ORDER BY wordid, urlid, location")
+        for (wordid, docs) in postings.groupwordlocations(cur):
+            postwordids.append(wordid)
+            postchunks.append(postings.encodepostings(docs))
+
+        urls = con.execute("SELECT rowid, url FROM urllist ORDER BY rowid").fetchall()
+        size = max([urlid for (urlid, url) in urls], default=0) + 1
+        urlchunks = [b''] * size
+        for (urlid, url) in urls:
+            urlchunks[urlid] = url.encode('utf-8')
+
+        inbound = np.zeros(size, dtype=np.int64)
+        for (toid, count) in con.execute("SELECT toid, COUNT(*) FROM link GROUP BY toid"):
+            if toid < size:
+                inbound[toid] = count
+        outdegree = np.zeros(size, dtype=np.int64)
+        for (fromid, count) in con.execute("SELECT fromid, COUNT(*) FROM link GROUP BY fromid"):
+            if fromid < size:
+                outdegree[fromid] = count
+        pagerank = np.zeros(size)
+        for (urlid, score) in con.execute("SELECT urlid, score FROM pagerank"):
+            if urlid < size and score is not None:
+                pagerank[urlid] = score
+
+        anchors = con.execute(
+            'SELECT linkwords.wordid, link.toid, SUM(pagerank.score) '
+            'FROM linkwords, link, pagerank '
+            'WHERE linkwords.linkid=link.rowid AND pagerank.urlid=link.fromid '
+            'GROUP BY linkwords.wordid, link.toid ORDER BY linkwords.wordid, link.toid'
+        ).fetchall()
+    finally:
+        con.rollback()
+        con.close()
+
+    data = {
+        'termoffsets': offsets([word for (word, wordid) in words]),
+        'terms': b''.join(word for (word, wordid) in words),
+        'termwordids': np.array([wordid for (word, wordid) in words], dtype=np.int64),
+        'postwordids': np.array(postwordids, dtype=np.int64),
+        'postoffsets': offsets(postchunks),
+        'postdata': b''.join(postchunks),
+        'inbound': inbound,
+        'pagerank': pagerank,
+        'outdegree': outdegree,
+        'urloffsets': offsets(urlchunks),
+        'urls': b''.join(urlchunks),
+        'anchorwordids': np.array([row[0] for row in anchors], dtype=np.int64),
+        'anchortoids': np.array([row[1] for row in anchors], dtype=np.int64),
+        'anchorscores': np.array([row[2] for row in anchors], dtype=np.float64)
+    }
+
+    tmppath = path + '.tmp'
+    with open(tmppath, 'wb') as f:
+        f.write(b'\0' * header.size)
+        places = []
+        for (name, dtype) in sections:
+            f.write(b'\0' * (-f.tell() % 8))
+            raw = data[name] if dtype is None else np.ascontiguousarray(data[name], dtype=dtype).tobytes()
+            places.extend([f.tell(), len(raw)])
+            f.write(raw)
+        f.seek(0)
+        f.write(header.pack(magic, generation, *places))
+    os.replace(tmppath, path)
+
+
+# Текст ссылок из снимка с тем же интерфейсом, что словарь
+# Searcher.anchortext: get(wordid) -> {toid: score}
+class AnchorText:
+    def __init__(self, wordids, toids, scores):
+        self.wordids = wordids
+        self.toids = toids
+        self.scores = scores
+
+    def get(self, wordid, default=None):
+        lo = np.searchsorted(self.wordids, wordid, 'left')
+        hi = np.searchsorted(self.wordids, wordid, 'right')
+        if lo == hi:
+            return default
+        return dict(zip(self.toids[lo:hi].tolist(), self.scores[lo:hi].tolist()))
+
+
+# Снимок индекса, отображённый в память только для чтения. Массивы - это
+# представления numpy прямо над страницами файла, копий не делается, и
+# процессы, открывшие один снимок, делят его страницы в кэше ОС. Отображение
+# освобождается, когда исчезают все ссылки на снимок и его массивы
+class Snapshot:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        values = header.unpack_from(self.map, 0)
+        if values[0] != magic:
+            raise ValueError(f'{path}: не снимок индекса')
+        self.generation = values[1]
+        self.view = memoryview(self.map)
+        for (i, (name, dtype)) in enumerate(sections):
+            (offset, length) = values[2 + 2 * i:4 + 2 * i]
+            if dtype is None:
+                setattr(self, name, self.view[offset:offset + length])
+            else:
+                setattr(self, name, np.frombuffer(self.map, dtype=dtype, count=length // np.dtype(dtype).itemsize,
+                                                  offset=offset))
+
+    def term(self, i):
+        return self.terms[int(self.termoffsets[i]):int(self.termoffsets[i + 1])].tobytes()
+
+    # wordid слова: двоичный поиск по упорядоченному словарю
+    def getwordid(self, word):
+        key = word.encode('utf-8')
+        lo = 0
+        hi = len(self.termwordids)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.term(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.termwordids) and self.term(lo) == key:
+            return int(self.termwordids[lo])
+        return None
+
+    def getpostings(self, wordid):
+        i = np.searchsorted(self.postwordids, wordid)
+        if i == len(self.postwordids) or self.postwordids[i] != wordid:
+            return [], []
+        return postings.decodepostings(self.postdata[int(self.postoffsets[i]):int(self.postoffsets[i + 1])])
+
+    def geturlname(self, urlid):
+        return self.urls[int(self.urloffsets[urlid]):int(self.urloffsets[urlid + 1])].tobytes().decode('utf-8')
+
+
+# Searcher, отвечающий по снимку без обращений к SQLite: словарь, списки
+# документов, признаки и URL читаются из отображённого файла. Поколение
+# индекса - то, на котором снимок собран
+class SnapshotSearcher(searchengine.Searcher):
+    def __init__(self, path, cache=None):
+        self.snapshot = Snapshot(path)
+        self.net = searchengine.mynet
+        self.cache = cache
+        self.generation = self.snapshot.generation
+        self.loadfeatures()
+
+    def __del__(self):
+        self.snapshot = None
+
+    def loadfeatures(self):
+        snap = self.snapshot
+        self.features = {'inbound': snap.inbound, 'pagerank': snap.pagerank, 'outdegree': snap.outdegree}
+        self.anchortext = AnchorText(snap.anchorwordids, snap.anchortoids, snap.anchorscores)
+
+    def getgeneration(self):
+        return self.snapshot.generation
+
+    def haspostings(self):
+        return True
+
+    def getpostings(self, wordid, usepostings=True):
+        return self.snapshot.getpostings(wordid)
+
+    def getpostingsmany(self, wordids):
+        return dict([(wordid, self.snapshot.getpostings(wordid)) for wordid in wordids])
+
+    def getwordid(self, word):
+        return self.snapshot.getwordid(word)
+
+    def getwordids(self, words):
+        wordids = [(word, self.snapshot.getwordid(word)) for word in words]
+        return dict([(word, wordid) for (word, wordid) in wordids if wordid is not None])
+
+    def geturlname(self, id):
+        return self.snapshot.geturlname(id)
+
+    def geturlnames(self, urlids):
+        return dict([(urlid, self.snapshot.geturlname(urlid)) for urlid in urlids])
+
+    # Рабочему потоку querymany соединение не нужно: снимок общий
+    def forkworker(self):
+        worker = copy.copy(self)
+        worker.net = self.net.fork()
+        worker.cache = None
+        return worker
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+    parser = argparse.ArgumentParser(description='Сборка снимка индекса для SnapshotSearcher')
+    parser.add_argument('db', help='база индекса')
+    parser.add_argument('snapshot', help='файл снимка')
+    args = parser.parse_args()
+    start = time.perf_counter()
+    compilesnapshot(args.db, args.snapshot)
+    print(f'Снимок {args.snapshot}: {os.path.getsize(args.snapshot)} байт за {time.perf_counter() - start:.2f} с')
@@ -0,0 +1,167 @@
+import argparse
+import contextlib
+import json
+import os
+import random
+import sys
+import tempfile
+import bench
+
+
+# Совпадают ли две выдачи [(оценка, urlid или url)]: те же документы в том
+# же порядке и оценки с точностью до tolerance
+def sameresults(a, b, tolerance=1e-9):
+    if len(a) != len(b):
+        return False
+    return all(x[1] == y[1] and abs(x[0] - y[0]) <= tolerance for (x, y) in zip(a, b))
+
+
+# Запросы из 1-3 слов с частотами корпуса, часть слов - фразой в кавычках
+def makequeries(vocab, wordweights, count, seed=0):
+    rnd = random.Random(seed)
+    queries = []
+    for _ in range(count):
+        words = rnd.choices(vocab, wordweights, k=rnd.randint(1, 3))
+        if len(words) > 1 and rnd.random() < 0.2:
+            words = ['"' + ' '.join(words[:2]) + '"'] + words[2:]
+        queries.append(' '.join(words))
+    return queries
+
+
+# gettopk против полной сортировки getscoredlist
+def checktopk(searcher, queries, k):
+    mismatches = []
+    matched = 0
+    for q in queries:
+        matches, wordids = searcher.getmatches(q)
+        matched += bool(matches)
+        scores = searcher.getscoredlist(matches, wordids)
+        expected = sorted([(score, urlid) for (urlid, score) in scores.items()], reverse=True)[:k]
+        if not sameresults(searcher.gettopk(matches, wordids, k), expected):
+            mismatches.append(q)
+    return {'queries': len(queries), 'matched': matched, 'mismatches': mismatches}
+
+
+# Выдача поисковика other против reference по тем же запросам. Документы
+# сравниваются по URL: urlid в разных базах могут не совпадать
+def checksearchers(reference, other, queries, k):
+    mismatches = []
+    for q in queries:
+        expected = [(score, url) for (score, urlid, url) in reference.search(q, k)[1]]
+        if not sameresults([(score, url) for (score, urlid, url) in other.search(q, k)[1]], expected):
+            mismatches.append(q)
+    return {'queries': len(queries), 'mismatches': mismatches}
+
+
+# Страницы bench.makecorpus все разные, поэтому ни одна не должна попасть
+# в дубликаты при обходе с dedup=True
+def checkdedup(crawler):
+    duplicates = [url for (url,) in crawler.con.execute(
+        "SELECT url FROM urllist WHERE rowid IN (SELECT urlid FROM fingerprints WHERE canonical IS NOT NULL)")]
+    return {'pages': crawler.con.execute("SELECT count(*) FROM fingerprints").fetchone()[0],
+            'mismatches': duplicates}
+
+
+# Дообновление PageRank против полного расчёта: после полного расчёта
+# добавляются changes случайных ссылок между проиндексированными страницами,
+# затем столько же ссылок на новые URL сайта base (они меняют сумму рангов
+# висячих страниц). После каждого шага ранги дообновляются и сравниваются
+# с новым полным расчётом с относительной точностью tolerance
+def checkpagerank(crawler, base, changes, seed=0, tolerance=1e-3):
+    rnd = random.Random(seed)
+    crawler.calculatepagerank()
+    urls = [url for (url,) in crawler.con.execute("SELECT url FROM urllist ORDER BY rowid")]
+    updates = []
+    mismatches = []
+    for step in range(2):
+        for i in range(changes):
+            target = rnd.choice(urls) if step == 0 else f'{base}/verify{i}'
+            crawler.addlinkref(rnd.choice(urls), target, 'verify')
+        crawler.dbcommit()
+        updates.append(crawler.calculatepagerank(incremental=True)[0])
+        incremental = dict(crawler.con.execute("SELECT urlid, score FROM pagerank"))
+        crawler.calculatepagerank()
+        mismatches.extend(url for (url, urlid, score) in crawler.con.execute(
+            "SELECT url, urlid, score FROM pagerank, urllist WHERE urllist.rowid=pagerank.urlid")
+            if abs(incremental.get(urlid, 1.0) - score) > tolerance * score)
+    # updates - число пересчётов вершин или, если понадобился полный расчёт,
+    # число его итераций
+    return {'changes': changes, 'updates': updates, 'mismatches': mismatches}
+
+
+# Проверка на синтетическом сайте из bench.makecorpus, что быстрые пути
+# поиска дают ту же выдачу, что и исходный расчёт. Базы создаются в
+# каталоге workdir
+def run(args):
+    os.chdir(args.workdir)
+    import searchengine
+    import shards
+    import snapshot
+
+    corpus, vocab, wordweights = bench.makecorpus(args.pages, args.vocabulary, args.words, args.links,
+                                                  seed=args.seed)
+    server, base = bench.servecorpus(corpus)
+    seeds = [base + path for path in corpus]
+    queries = makequeries(vocab, wordweights, args.queries, args.seed + 1)
+    report = {}
+    devnull = open(os.devnull, 'w')
+    try:
+        dbname = os.path.join(args.workdir, 'verify.db')
+        with contextlib.redirect_stdout(devnull):
+            crawler = searchengine.Crawler(dbname, bulk=True, dedup=True)
+            crawler.createindextables()
+            crawler.crawl(seeds, 1)
+            crawler.buildpostings()
+            crawler.calculatepagerank()
+        report['dedup'] = checkdedup(crawler)
+        searcher = searchengine.Searcher(dbname)
+        report['topk'] = checktopk(searcher, queries, args.k)
+
+        snapshotpath = os.path.join(args.workdir, 'verify.snap')
+        snapshot.compilesnapshot(dbname, snapshotpath)
+        report['snapshot'] = checksearchers(searcher, snapshot.SnapshotSearcher(snapshotpath), queries, args.k)
+
+        shardedname = os.path.join(args.workdir, 'verifysharded.db')
+        with contextlib.redirect_stdout(devnull):
+            crawler = shards.ShardedCrawler(shardedname, args.shards)
+            crawler.createindextables()
+            crawler.crawl(seeds, 1)
+            crawler.buildpostings()
+            crawler.calculatepagerank()
+            crawler.close()
+        sharded = shards.ShardedSearcher(shardedname, args.shards)
+        try:
+            report['sharded'] = checksearchers(searcher, sharded, queries, args.k)
+        finally:
+            sharded.close()
+
+        prname = os.path.join(args.workdir, 'verifypagerank.db')
+        with contextlib.redirect_stdout(devnull):
+            crawler = searchengine.Crawler(prname, bulk=True)
+            crawler.createindextables()
+            crawler.crawl(seeds, 1)
+            report['pagerank'] = checkpagerank(crawler, base, args.changes, args.seed)
+    finally:
+        server.shutdown()
+        devnull.close()
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Сверка быстрых путей поиска с исходным ранжированием')
+    parser.add_argument('--pages', type=int, default=200)
+    parser.add_argument('--vocabulary', type=int, default=1000)
+    parser.add_argument('--words', type=int, default=200, help='слов на странице')
+    parser.add_argument('--links', type=int, default=10, help='ссылок на странице')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--shards', type=int, default=3)
+    parser.add_argument('--changes', type=int, default=10, help='новых ссылок для дообновления PageRank')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', default=None, help='каталог для баз (по умолчанию временный)')
+    args = parser.parse_args()
+    args.workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix='searchverify'))
+
+    report = run(args)
+    print(json.dumps(report, ensure_ascii=False))
+    sys.exit(1 if any(check['mismatches'] for check in report.values()) else 0)